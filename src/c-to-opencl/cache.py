@@ -0,0 +1,127 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+from typing import Optional, Union
+import pycparser
+
+
+def default_cache_dir() -> str:
+    return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "c-to-opencl")
+
+
+def translator_version() -> str:
+    # The translator's own source stands in for a version number, so any change to it misses the cache
+    digest = hashlib.sha256()
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(os.path.join(package_dir, "*.py"))):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def translation_key(source: str, preprocessed: str, cpp_args: list[str], options: dict) -> str:
+    # Templates are read from the working directory by host, just like here
+    templates = {}
+    for path in sorted(glob.glob("*.template")):
+        with open(path, "r") as f:
+            templates[path] = f.read()
+    digest = hashlib.sha256()
+    digest.update(json.dumps([translator_version(), templates, cpp_args, options, source, preprocessed],
+                             sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def prelude_key(prelude: str) -> str:
+    # The preprocessed headers already reflect the include paths and macro definitions they were expanded with
+    digest = hashlib.sha256()
+    digest.update(json.dumps([pycparser.__version__, prelude]).encode())
+    return "prelude-" + digest.hexdigest()
+
+
+class TranslationCache:
+    directory: str
+    max_size: int
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> Optional[tuple[str, str]]:
+        entry = self.entry_path(key)
+        try:
+            with open(os.path.join(entry, "host.c"), "r") as f:
+                host_code = f.read()
+            with open(os.path.join(entry, "kernel.cl"), "r") as f:
+                cl_output = f.read()
+        except OSError:
+            return None
+        # An entry's modification time records when it was last used, for eviction
+        os.utime(entry)
+        return host_code, cl_output
+
+    def put(self, key: str, host_code: str, cl_output: str) -> None:
+        self.put_entry(key, {"host.c": host_code, "kernel.cl": cl_output})
+
+    def private(self, path: str) -> bool:
+        try:
+            info = os.stat(path)
+        except OSError:
+            return False
+        return info.st_uid == os.getuid() and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+    def get_prelude(self, key: str) -> Optional[bytes]:
+        # Preludes are unpickled, which can run code, so they are only read from entries nobody else could have written
+        entry = self.entry_path(key)
+        if not self.private(self.directory) or not self.private(entry):
+            return None
+        try:
+            with open(os.path.join(entry, "prelude.pickle"), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        os.utime(entry)
+        return data
+
+    def put_prelude(self, key: str, data: bytes) -> None:
+        self.put_entry(key, {"prelude.pickle": data})
+
+    def put_entry(self, key: str, files: dict[str, Union[str, bytes]]) -> None:
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        # Entries are written to a temporary directory and renamed into place, so concurrent translations of the
+        # same file never see a half written entry
+        staging = tempfile.mkdtemp(dir=self.directory, prefix=".staging-")
+        for name, contents in files.items():
+            with open(os.path.join(staging, name), "wb" if isinstance(contents, bytes) else "w") as f:
+                f.write(contents)
+        try:
+            os.rename(staging, self.entry_path(key))
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def evict(self) -> None:
+        # Least recently used entries are removed until the cache fits in max_size bytes
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.directory):
+            entry = self.entry_path(name)
+            if name.startswith(".") or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, file)) for file in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                continue
+            total_size += size
+        for _, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
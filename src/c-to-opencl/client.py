@@ -0,0 +1,49 @@
+import json
+import os
+import socket
+import struct
+import sys
+
+# Only the standard library is imported here, so the client starts quickly and leaves the parsing to the server
+
+
+def send_message(connection: socket.socket, message: dict) -> None:
+    data = json.dumps(message).encode()
+    connection.sendall(struct.pack("!I", len(data)) + data)
+
+
+def receive_exactly(connection: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed before the whole message was received")
+        data += chunk
+    return data
+
+
+def receive_message(connection: socket.socket) -> dict:
+    size, = struct.unpack("!I", receive_exactly(connection, 4))
+    return json.loads(receive_exactly(connection, size))
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python -m c-to-opencl.client SOCKET ARGS...", file=sys.stderr)
+        sys.exit(2)
+    socket_path, argv = sys.argv[1], sys.argv[2:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        send_message(connection, {"argv": argv, "cwd": os.getcwd()})
+        reply = receive_message(connection)
+
+    for path, code in reply["outputs"].items():
+        with open(path, 'w') as f:
+            f.write(code)
+    sys.stdout.write(reply["stdout"])
+    sys.stderr.write(reply["stderr"])
+    sys.exit(reply["status"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+import argparse
+import contextlib
+import functools
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+import pycparser
+
+from . import cache
+from . import prelude
+from . import translate
+from . import host
+from . import stats
+
+# Arguments that only say where files go or how the run is reported, rather than what the translation produces
+UNCACHED_ARGUMENTS = {"files", "batch", "jobs", "stats", "cache_dir", "cache_size", "no_cache"}
+
+# pycparser's stand-ins for the standard headers, which are parsed once and then kept in the cache
+FAKE_INCLUDE_DIRS = ["utils/fake_libc_include", "utils/fake_omp_include"]
+
+
+@functools.lru_cache(maxsize=None)
+def get_parser() -> prelude.PreludeParser:
+    # Building the parser's tables is a large part of translating a small file, so one parser is shared
+    return prelude.PreludeParser()
+
+
+def build_argparser() -> argparse.ArgumentParser:
+    argparser = argparse.ArgumentParser(prog="c-to-opencl")
+    argparser.add_argument('-I', help='c include path', action="append")
+    argparser.add_argument('-D', help='c macro definition', action="append")
+    argparser.add_argument('--embed-kernel', help='compile the kernel source into the host program instead of '
+                           'reading kernel_file at runtime', action="store_true")
+    argparser.add_argument('--offload-threshold', help='smallest domain size to run on the OpenCL device, either N '
+                           'for every kernel or KERNEL=N for one kernel; can be overridden at runtime with the '
+                           'OFFLOAD_THRESHOLD and OFFLOAD_THRESHOLD_<KERNEL> environment variables', action="append")
+    argparser.add_argument('--coarsen', help='number of loop iterations each work-item runs, either N for every '
+                           'parallel for kernel or KERNEL=N for one kernel; overridden by a coarsen(N) clause on '
+                           'the pragma', action="append")
+    argparser.add_argument('--coarsen-mode', help='whether a coarsened work-item runs iterations a global size '
+                           'apart or next to each other', choices=["strided", "blocked"], default="strided")
+    argparser.add_argument('--vectorize', help='run elementwise float and int loops with OpenCL vector types',
+                           action="store_true")
+    argparser.add_argument('--vector-width', help='number of elements in each vector used by --vectorize',
+                           type=int, choices=[2, 4, 8, 16], default=4)
+    argparser.add_argument('--stream', help='move the arrays of parallel for kernels that only access a[i] through '
+                           'the device in chunks, overlapping transfers with the kernel', action="store_true")
+    argparser.add_argument('--stream-chunk-size', help='number of loop iterations in each chunk moved by --stream',
+                           type=int, default=1 << 20)
+    argparser.add_argument('--async', help='return from kernel launches without waiting, and only wait for a '
+                           'kernel before the host next uses its arrays', action="store_true", dest="asynchronous")
+    argparser.add_argument('--zero-copy', help='create buffers over the host arrays and map them instead of copying '
+                           'when the device shares memory with the host', action="store_true")
+    argparser.add_argument('--profile', help='emit a host program that times every transfer and kernel launch and '
+                           'writes per-kernel totals to PROFILE_FILE as JSON when it exits', metavar='PROFILE_FILE')
+    argparser.add_argument('--autotune', help='emit a host program that times a range of work-group sizes for each '
+                           'kernel on the device it runs on and writes the fastest to AUTOTUNE_FILE',
+                           metavar='AUTOTUNE_FILE')
+    argparser.add_argument('--work-group-sizes', help='JSON file of work-group sizes written by an --autotune '
+                           'program')
+    argparser.add_argument('--stats', help='write JSON with the wall time and peak memory growth of each translation '
+                           'phase and counts of what was translated to STATS_FILE, or to stdout for -',
+                           metavar='STATS_FILE')
+    argparser.add_argument('--cache-dir', help='directory of previously generated outputs, reused when the '
+                           'preprocessed source, options, templates and translator are unchanged',
+                           default=cache.default_cache_dir())
+    argparser.add_argument('--cache-size', help='size in MiB the cache is kept under by removing the least recently '
+                           'used outputs', type=int, default=256)
+    argparser.add_argument('--no-cache', help='always translate, and leave the cache untouched',
+                           action="store_true")
+    argparser.add_argument('--incremental', help='keep a manifest of the OpenMP regions in KERNEL_FILE.manifest, and '
+                           'on later runs keep each kernel\'s name and reuse the kernels whose regions are unchanged',
+                           action="store_true")
+    argparser.add_argument('--batch', help='translate every c file given, or found in a given directory, in '
+                           'parallel and write NAME.c and NAME.cl for each to OUTPUT_DIR', metavar='OUTPUT_DIR')
+    argparser.add_argument('--jobs', help='number of processes used by --batch', type=int, default=os.cpu_count())
+    argparser.add_argument('files', help='path to c file to translate, path to write c file containing host code '
+                           'and path to write cl file containing kernel code; with --batch, the c files and '
+                           'directories to translate', nargs='*', metavar='FILE')
+    argparser.add_argument('--serve', help='keep a parser warm and translate requests from '
+                           '"python -m c-to-opencl.client SOCKET ARGS..." sent to the unix socket SOCKET',
+                           metavar='SOCKET')
+    return argparser
+
+
+def run(argparser: argparse.ArgumentParser, args: argparse.Namespace, outputs: Optional[dict[str, str]] = None) -> int:
+    if args.batch:
+        return 1 if translate_batch(argparser, args) else 0
+    if len(args.files) != 3:
+        argparser.error("expected input_file, output_file and kernel_file")
+    report = translate_file(args, *args.files, outputs=outputs)
+    if report is not None:
+        write_stats(args.stats, report)
+    return 0
+
+
+def translate_file(args: argparse.Namespace, input_file: str, output_file: str, kernel_file: str,
+                   outputs: Optional[dict[str, str]] = None) -> Optional[dict]:
+    cpp_args = ["-I" + path for path in FAKE_INCLUDE_DIRS]
+    if args.I:
+        cpp_args += ["-I" + path for path in args.I]
+    if args.D:
+        cpp_args += ["-D" + path for path in args.D]
+
+    translation_stats = stats.TranslationStats() if args.stats else None
+
+    def phase(name: str):
+        return translation_stats.phase(name) if translation_stats else contextlib.nullcontext()
+
+    local_sizes = {}
+    if args.work_group_sizes:
+        with open(args.work_group_sizes, 'r') as f:
+            local_sizes = json.load(f)
+
+    # Kernel names depend on the manifest from the previous run as well, so incremental runs skip the output cache
+    previous_manifest = None
+    manifest_file = kernel_file + ".manifest"
+    if args.incremental:
+        previous_manifest = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as f:
+                previous_manifest = json.load(f)
+
+    with phase("preprocess"):
+        text = pycparser.preprocess_file(input_file, cpp_args=cpp_args)
+
+    translation_cache = None if args.no_cache else cache.TranslationCache(args.cache_dir, args.cache_size << 20)
+    use_cached_outputs = translation_cache is not None and not args.incremental
+    if use_cached_outputs:
+        with phase("cache"):
+            with open(input_file, 'r') as f:
+                source = f.read()
+            options = {name: value for name, value in vars(args).items() if name not in UNCACHED_ARGUMENTS}
+            options.update(kernel_file=kernel_file, work_group_sizes=local_sizes)
+            key = cache.translation_key(source, text, cpp_args, options)
+            cached = translation_cache.get(key)
+        if cached:
+            host_code, cl_output = cached
+            with phase("write"):
+                write_outputs({output_file: host_code, kernel_file: cl_output}, outputs)
+            return {"phases": translation_stats.phases, "cache": "hit"} if translation_stats else None
+
+    with phase("parse"):
+        ast = prelude.parse(get_parser(), text, input_file, FAKE_INCLUDE_DIRS, translation_cache)
+    coarsening = {}
+    for factor in args.coarsen or []:
+        name, _, value = factor.rpartition("=")
+        coarsening[name] = int(value)
+    with phase("translate"):
+        result = translate.translate_ast(ast, coarsening, args.coarsen_mode,
+                                         args.vector_width if args.vectorize else 1, args.stream, args.asynchronous,
+                                         previous_manifest)
+    cl_output = result.kernel_source
+    kernels_info = result.kernels_info
+    for threshold in args.offload_threshold or []:
+        name, _, value = threshold.rpartition("=")
+        for kernel_info in kernels_info:
+            if not name or name == kernel_info.name:
+                kernel_info.offload_threshold = int(value)
+    for kernel_info in kernels_info:
+        sizes = local_sizes.get(kernel_info.name)
+        if sizes and kernel_info.domain_sizes and len(sizes) == len(kernel_info.domain_sizes):
+            kernel_info.local_sizes = sizes
+    data_regions_info = result.data_regions_info
+    options = host.HostOptions(kernel_source=cl_output if args.embed_kernel else None,
+                               autotune_results=args.autotune, stream_chunk_size=args.stream_chunk_size,
+                               zero_copy=args.zero_copy, profile_results=args.profile)
+    with phase("host"):
+        host_code = host.process_original_file(input_file, kernels_info, kernel_file, data_regions_info,
+                                               options, result.sync_points)
+    with phase("write"):
+        files = {output_file: host_code, kernel_file: cl_output}
+        if result.manifest is not None:
+            files[manifest_file] = json.dumps(result.manifest, indent=4)
+        write_outputs(files, outputs)
+        if use_cached_outputs:
+            translation_cache.put(key, host_code, cl_output)
+
+    if translation_stats:
+        report = translation_stats.report(ast, result, FAKE_INCLUDE_DIRS)
+        report["cache"] = "miss" if use_cached_outputs else "disabled"
+        return report
+    return None
+
+
+def write_outputs(files: dict[str, str], outputs: Optional[dict[str, str]] = None) -> None:
+    # The server hands the code back to its client to write instead
+    if outputs is not None:
+        outputs.update(files)
+        return
+    for path, code in files.items():
+        with open(path, 'w') as f:
+            f.write(code)
+
+
+def write_stats(path: str, report: dict) -> None:
+    if path == "-":
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    else:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+def find_batch_inputs(paths: list[str]) -> list[str]:
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            inputs += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".c"))
+        else:
+            inputs.append(path)
+    return inputs
+
+
+def translate_batch(argparser: argparse.ArgumentParser, args: argparse.Namespace) -> bool:
+    inputs = find_batch_inputs(args.files)
+    outputs = {}
+    for input_file in inputs:
+        name = os.path.splitext(os.path.basename(input_file))[0]
+        if name in outputs:
+            argparser.error(f"{outputs[name]} and {input_file} would both be written to {name}.c")
+        outputs[name] = input_file
+    os.makedirs(args.batch, exist_ok=True)
+
+    # Forked workers start with pycparser and the translator already imported, and each builds its parser once
+    futures = {}
+    with ProcessPoolExecutor(max_workers=args.jobs, mp_context=multiprocessing.get_context("fork")) as executor:
+        for name, input_file in outputs.items():
+            output_file = os.path.join(args.batch, name + ".c")
+            kernel_file = os.path.join(args.batch, name + ".cl")
+            futures[input_file] = executor.submit(translate_file, args, input_file, output_file, kernel_file)
+
+    # A file that fails to translate is reported without stopping the rest of the batch
+    failed = False
+    reports = {}
+    for input_file, future in futures.items():
+        error = future.exception()
+        if error is not None:
+            print(f"{input_file}: {type(error).__name__}: {error}", file=sys.stderr)
+            failed = True
+        else:
+            reports[input_file] = future.result()
+    print(f"Translated {len(reports)} of {len(futures)} files", file=sys.stderr)
+    if args.stats:
+        write_stats(args.stats, reports)
+    return failed
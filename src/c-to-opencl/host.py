@@ -1,13 +1,151 @@
-from .translate import KernelInfo, TranslationVisitor
+import json
+import re
+from dataclasses import dataclass
+from typing import Optional
+from .source import SourceIndex
+from .translate import DataRegionInfo, KernelArg, KernelInfo, TranslationVisitor, reduction_combine
 from pycparser import c_ast
 
 
-def generate_host_function(kernel_id: int, kernel_info: KernelInfo) -> str:
+@dataclass
+class HostOptions:
+    kernel_source: Optional[str] = None  # compiled into the host program instead of read at runtime
+    autotune_results: Optional[str] = None  # emit a harness that writes tuned work-group sizes to this path
+    stream_chunk_size: int = 1 << 20  # elements per chunk for streamed kernels
+    zero_copy: bool = False  # map host arrays into buffers when the device shares memory with the host
+    profile_results: Optional[str] = None  # time every command and write per-kernel totals to this path
+
+
+def check_error(message: str, indent: str = "    ") -> str:
+    return (f"{indent}if (err != CL_SUCCESS) {{\n"
+            f"{indent}    fprintf(stderr, \"OpenCL Error: {message} %d\\n\", err);\n"
+            f"{indent}    exit(EXIT_FAILURE);\n"
+            f"{indent}}}\n")
+
+
+def indent_lines(code: Optional[str], indent: str) -> str:
+    return "".join(f"{indent}{line}\n" for line in code.splitlines()) if code else ""
+
+
+def create_buffer_code(buffer: str, flags: str, size: str, indent: str = "    ",
+                       host_ptr: Optional[str] = None) -> str:
+    if host_ptr is None:
+        return (f"{buffer} = buffer_pool_acquire({flags}, {size}, &err);\n" +
+                check_error("Failed to create buffer.", indent))
+    # Zero-copy buffers wrap the host array itself, so they can't come from the pool
+    return ("if (zero_copy)\n"
+            f"{indent}    {buffer} = clCreateBuffer(context, {flags} | CL_MEM_USE_HOST_PTR, {size}, {host_ptr}, "
+            "&err);\n"
+            f"{indent}else\n"
+            f"{indent}    {buffer} = buffer_pool_acquire({flags}, {size}, &err);\n" +
+            check_error("Failed to create buffer.", indent))
+
+
+def write_buffer_code(buffer: str, size: str, host_ptr: str, indent: str = "    ",
+                      wait_list: Optional[str] = None, event: Optional[str] = None, zero_copy: bool = False,
+                      profile: Optional[str] = None) -> str:
+    blocking = "CL_FALSE" if event else "CL_TRUE"
+    code = (f"err = clEnqueueWriteBuffer(command_queue, {buffer}, {blocking}, 0, {size}, {host_ptr}, "
+            f"{wait_list or '0, NULL'}, {event or 'NULL'});\n")
+    if not zero_copy:
+        return code + check_error("Failed to write to buffer.", indent) + indent_lines(profile, indent)
+    # A buffer created over the host array already holds its contents
+    return (f"if (!zero_copy) {{\n"
+            f"{indent}    " + code +
+            check_error("Failed to write to buffer.", indent + "    ") +
+            indent_lines(profile, indent + "    ") +
+            f"{indent}}}\n")
+
+
+def read_buffer_code(buffer: str, size: str, host_ptr: str, indent: str = "    ",
+                     wait_list: Optional[str] = None, event: Optional[str] = None, zero_copy: bool = False,
+                     profile: Optional[str] = None) -> str:
+    blocking = "CL_FALSE" if event else "CL_TRUE"
+    code = (f"err = clEnqueueReadBuffer(command_queue, {buffer}, {blocking}, 0, {size}, {host_ptr}, "
+            f"{wait_list or '0, NULL'}, {event or 'NULL'});\n")
+    if not zero_copy:
+        return code + check_error("Failed to read from buffer.", indent) + indent_lines(profile, indent)
+    # Mapping a buffer created over the host array brings the array up to date, unmapping hands it back
+    return ("if (zero_copy) {\n"
+            f"{indent}    cl_event mapped_event;\n"
+            f"{indent}    void *mapped = clEnqueueMapBuffer(command_queue, {buffer}, {blocking}, CL_MAP_READ, 0, "
+            f"{size}, {wait_list or '0, NULL'}, &mapped_event, &err);\n" +
+            check_error("Failed to map buffer.", indent + "    ") +
+            f"{indent}    err = clEnqueueUnmapMemObject(command_queue, {buffer}, mapped, 1, &mapped_event, "
+            f"{event or 'NULL'});\n" +
+            check_error("Failed to unmap buffer.", indent + "    ") +
+            f"{indent}    clReleaseEvent(mapped_event);\n"
+            f"{indent}}} else {{\n"
+            f"{indent}    " + code +
+            check_error("Failed to read from buffer.", indent + "    ") +
+            f"{indent}}}\n" +
+            indent_lines(profile, indent))
+
+
+def profile_code(times: str, event: str, size: str, release: bool) -> str:
+    # Profiled commands of synchronous kernels get their own event, which nothing else waits on
+    return f"profile_event({times}, {event}, {size});" + (f"\nclReleaseEvent({event});" if release else "")
+
+
+def defer_profile_code(kernel_id: int, times: str, event: str, size: str, release: bool) -> str:
+    # Commands that overlap with others are only profiled once they are waited for anyway
+    return (f"profile_defer(&kernel_profiles[{kernel_id}], &kernel_profiles[{kernel_id}].{times}, {event}, {size});" +
+            (f"\nclReleaseEvent({event});" if release else ""))
+
+
+def release_buffer_code(buffer: str, indent: str = "    ") -> str:
+    return f"err = buffer_pool_release({buffer});\n" + check_error("Failed to release buffer.", indent)
+
+
+def buffer_flags(arg: KernelArg) -> str:
+    # Buffers shared between kernels are read and written by different kernels
+    if arg.resident:
+        return "CL_MEM_READ_WRITE"
+    if arg.read and not arg.written:
+        return "CL_MEM_READ_ONLY"
+    elif arg.written and not arg.read:
+        return "CL_MEM_WRITE_ONLY"
+    else:
+        return "CL_MEM_READ_WRITE"
+
+
+def kernel_buffer(kernel_id: int, kernel_info: KernelInfo, arg: KernelArg) -> str:
+    if arg.resident:
+        return arg.resident
+    # Buffers of asynchronous kernels outlive the host function, until opencl_wait releases them
+    return f"{arg.name}_cl{kernel_id}" if kernel_info.asynchronous else f"{arg.name}_cl"
+
+
+def dependencies_code(kernel_info: KernelInfo, size: int) -> str:
+    code = ("// Earlier kernels still using the same arrays\n"
+            f"    cl_event waits[{max(size, 1)}];\n"
+            "    cl_uint num_waits = 0;\n")
+    for k in kernel_info.dependencies:
+        code += (f"    if (kernel{k}_done)\n"
+                 f"        waits[num_waits++] = kernel{k}_done;\n")
+    return code
+
+
+def wait_for_dependencies_code(kernel_info: KernelInfo) -> str:
+    return (dependencies_code(kernel_info, len(kernel_info.dependencies)) +
+            "    if (num_waits) {\n"
+            "        err = clWaitForEvents(num_waits, waits);\n" +
+            check_error("Failed to wait for events.", "        ") +
+            "    }")
+
+
+def generate_host_function(kernel_id: int, kernel_info: KernelInfo, options: HostOptions) -> str:
     visitor = TranslationVisitor()
     with open("host_function.c.template", "r") as f:
         template = f.read()
 
     template = template.replace("<KERNEL_ID>", f"{kernel_id}")
+    work_dim = len(kernel_info.domain_sizes) if kernel_info.domain_sizes else 1
+    template = template.replace("<WORK DIM>", f"{work_dim}")
+    global_sizes = [f"domain_size{d}" for d in range(work_dim)]
+    if kernel_info.coarsening > 1:
+        global_sizes[0] = f"(domain_size0 + {kernel_info.coarsening - 1}) / {kernel_info.coarsening}"
+    template = template.replace("<GLOBAL SIZE>", ", ".join(global_sizes))
 
     buffer_decls = []
     create_buffers = []
@@ -16,35 +154,56 @@ def generate_host_function(kernel_id: int, kernel_info: KernelInfo) -> str:
     release_buffers = []
     set_kernel_args = []
 
+    # Asynchronous kernels chain their commands with events: uploads wait for the kernels they depend on, the
+    # kernel waits for the uploads and the reads wait for the kernel
+    uploads = [arg for arg in kernel_info.args if arg.is_buffer() and arg.create and arg.read]
+    downloads = [arg for arg in kernel_info.args if arg.is_buffer() and arg.release and arg.written]
+    if kernel_info.asynchronous:
+        buffer_decls.append(dependencies_code(kernel_info, len(kernel_info.dependencies) + len(uploads)) +
+                            "    cl_uint num_dependencies = num_waits;\n"
+                            f"    cl_event events[{len(downloads) + 1}];")
+    elif kernel_info.dependencies:
+        buffer_decls.append(wait_for_dependencies_code(kernel_info))
+    profile = options.profile_results is not None
+    if profile and not kernel_info.asynchronous:
+        buffer_decls.append("cl_event profiled_event;")
+
     for i, arg in enumerate(kernel_info.args):
-        if type(arg.type) is c_ast.PtrDecl or type(arg.type) is c_ast.ArrayDecl:
-            tp = visitor.visit(arg.type.type)
-            buffer_decls.append(f"cl_mem {arg.name}_cl;")
-            create_buffers.append(f"{arg.name}_cl = clCreateBuffer(context, CL_MEM_READ_WRITE, "
-                                  f"{arg.size}, NULL, &err);\n"
-                                  "    if (err != CL_SUCCESS) {\n"
-                                  "        fprintf(stderr, \"OpenCL Error: Failed to create buffer. %d\\n\", err);\n"
-                                  "        exit(EXIT_FAILURE);\n"
-                                  "    }\n")
-            write_buffers.append(f"err = clEnqueueWriteBuffer(command_queue, {arg.name}_cl, CL_TRUE,"
-                                 f" 0, {arg.size}, {arg.name}, 0, NULL, NULL);\n"
-                                 "    if (err != CL_SUCCESS) {\n"
-                                 "        fprintf(stderr, \"OpenCL Error: Failed to write to buffer. %d\\n\", err);\n"
-                                 "        exit(EXIT_FAILURE);\n"
-                                 "    }\n")
-            read_buffers.append(f"err = clEnqueueReadBuffer(command_queue, {arg.name}_cl, CL_TRUE, "
-                                f"0, {arg.size}, {arg.name}, 0, NULL, NULL);\n"
-                                "    if (err != CL_SUCCESS) {\n"
-                                "        fprintf(stderr, \"OpenCL Error: Failed to read from buffer. %d\\n\", err);\n"
-                                "        exit(EXIT_FAILURE);\n"
-                                "    }\n")
-            release_buffers.append(f"err = clReleaseMemObject({arg.name}_cl);\n"
-                                   "    if (err != CL_SUCCESS) {\n"
-                                   "        fprintf(stderr, \"OpenCL Error: Failed to release buffer. %d\\n\", err);\n"
-                                   "        exit(EXIT_FAILURE);\n"
-                                   "    }\n")
+        if arg.is_buffer():
+            buffer = kernel_buffer(kernel_id, kernel_info, arg)
+            if not arg.resident and not kernel_info.asynchronous:
+                buffer_decls.append(f"cl_mem {buffer};")
+            if arg.create:
+                create_buffers.append(create_buffer_code(buffer, buffer_flags(arg), arg.size,
+                                                         host_ptr=arg.name if options.zero_copy else None))
+                if arg.read:
+                    if kernel_info.asynchronous:
+                        wait_list, event = "num_dependencies, num_dependencies ? waits : NULL", \
+                            "&waits[num_waits++]"
+                        recorded = defer_profile_code(kernel_id, "writes", "waits[num_waits - 1]", arg.size, False)
+                    else:
+                        wait_list, event = None, "&profiled_event" if profile else None
+                        recorded = profile_code(f"&kernel_profiles[{kernel_id}].writes", "profiled_event",
+                                                arg.size, True)
+                    write_buffers.append(write_buffer_code(buffer, arg.size, arg.name, wait_list=wait_list,
+                                                           event=event, zero_copy=options.zero_copy,
+                                                           profile=recorded if profile else None))
+            if arg.release:
+                if arg.written:
+                    if kernel_info.asynchronous:
+                        wait_list, event = "1, &events[0]", f"&events[{downloads.index(arg) + 1}]"
+                        recorded = defer_profile_code(kernel_id, "reads", event[1:], arg.size, False)
+                    else:
+                        wait_list, event = None, "&profiled_event" if profile else None
+                        recorded = profile_code(f"&kernel_profiles[{kernel_id}].reads", "profiled_event",
+                                                arg.size, True)
+                    read_buffers.append(read_buffer_code(buffer, arg.size, arg.name, wait_list=wait_list,
+                                                         event=event, zero_copy=options.zero_copy,
+                                                         profile=recorded if profile else None))
+                if not kernel_info.asynchronous:
+                    release_buffers.append(release_buffer_code(buffer))
             set_kernel_args.append(f"err = clSetKernelArg(kernel{kernel_id}, {i}, sizeof(cl_mem), "
-                                   f"&{arg.name}_cl);\n"
+                                   f"&{buffer});\n"
                                    "    if (err != CL_SUCCESS) {\n"
                                    "        fprintf(stderr, \"OpenCL Error: Failed to set kernel argument. %d\\n\", "
                                    "err);\n"
@@ -59,6 +218,101 @@ def generate_host_function(kernel_id: int, kernel_info: KernelInfo) -> str:
                                    "        exit(EXIT_FAILURE);\n"
                                    "    }\n")
 
+    # Reductions leave one partial result per work-group, which are combined here
+    reductions = [arg for arg in kernel_info.args if arg.reduction]
+    for j, arg in enumerate(reductions):
+        tp = visitor.visit(arg.type)
+        partials = f"{arg.name}_partials"
+        size = f"groups * sizeof({tp})"
+        buffer_decls.append(f"cl_mem {partials}_cl;")
+        create_buffers.append(create_buffer_code(f"{partials}_cl", "CL_MEM_WRITE_ONLY", size))
+        set_kernel_args.append(f"err = clSetKernelArg(kernel{kernel_id}, {len(kernel_info.args) + 2 * j}, "
+                               f"sizeof(cl_mem), &{partials}_cl);\n" +
+                               check_error("Failed to set kernel argument."))
+        set_kernel_args.append(f"err = clSetKernelArg(kernel{kernel_id}, {len(kernel_info.args) + 2 * j + 1}, "
+                               f"local[0] * sizeof({tp}), NULL);\n" +
+                               check_error("Failed to set kernel argument."))
+        read_buffers.append(f"{tp} *{partials} = malloc({size});\n    " +
+                            read_buffer_code(f"{partials}_cl", size, partials,
+                                             event="&profiled_event" if profile else None,
+                                             profile=profile_code(f"&kernel_profiles[{kernel_id}].reads",
+                                                                  "profiled_event", size, True)
+                                             if profile else None) +
+                            "    for (size_t group = 0; group < groups; group++)\n"
+                            f"        {arg.name} = " +
+                            reduction_combine(arg.reduction, arg.name, f"{partials}[group]") + ";\n"
+                            f"    free({partials});\n")
+        release_buffers.append(release_buffer_code(f"{partials}_cl"))
+
+    if reductions:
+        # The tree reduction needs a power of two work-group size that divides the global size, which
+        # choose_local_size gives when it isn't handed a preferred size
+        template = template.replace("<WORK SIZES>", f"choose_local_size(local{kernel_id}, work_dim, global, local, "
+                                    "NULL);\n"
+                                    "    size_t groups = global[0] / local[0];\n")
+        template = template.replace("<LOCAL SIZE>", "local")
+    elif kernel_info.domain_sizes is not None:
+        if options.autotune_results is not None:
+            preferred = f"autotuned{kernel_id} ? autotuned_local{kernel_id} : NULL"
+            # Tuning runs the kernel several times, so the buffers it writes have to be restored
+            tuned = [arg for arg in kernel_info.args if arg.is_buffer() and arg.written]
+            if tuned:
+                buffers = ("        cl_mem tuned_buffers[] = {" +
+                           ", ".join(kernel_buffer(kernel_id, kernel_info, arg) for arg in tuned) + "};\n"
+                           "        size_t tuned_sizes[] = {" + ", ".join(arg.size for arg in tuned) + "};\n")
+                buffer_args = f"{len(tuned)}, tuned_buffers, tuned_sizes"
+            else:
+                buffers, buffer_args = "", "0, NULL, NULL"
+            set_kernel_args.append(f"if (!autotuned{kernel_id}) {{\n"
+                                   f"        size_t domain[{work_dim}] = {{" + ", ".join(global_sizes) + "};\n" +
+                                   buffers +
+                                   f"        autotune_kernel(kernel{kernel_id}, local{kernel_id}, work_dim, domain, "
+                                   f"autotuned_local{kernel_id},\n"
+                                   f"                        {buffer_args});\n"
+                                   f"        autotuned{kernel_id} = 1;\n"
+                                   "    }\n")
+        elif kernel_info.local_sizes is not None:
+            preferred = "preferred_local"
+        else:
+            preferred = "NULL"
+        work_sizes = f"choose_local_size(local{kernel_id}, work_dim, global, local, {preferred});\n"
+        if preferred == "preferred_local":
+            work_sizes = f"size_t preferred_local[{work_dim}] = {{" + \
+                         ", ".join(str(size) for size in kernel_info.local_sizes) + "};\n    " + work_sizes
+        template = template.replace("<WORK SIZES>", work_sizes)
+        template = template.replace("<LOCAL SIZE>", "local")
+    else:
+        template = template.replace("<WORK SIZES>", "")
+        template = template.replace("<LOCAL SIZE>", "NULL")
+
+    if kernel_info.asynchronous:
+        template = template.replace("<KERNEL EVENTS>", "num_waits, num_waits ? waits : NULL, &events[0]")
+        template = template.replace("<FINISH KERNEL>", indent_lines(
+            f"kernel_profiles[{kernel_id}].launches++;\n" +
+            defer_profile_code(kernel_id, "kernel", "events[0]", "0", False), "    ")
+            if profile else "")
+        read_buffers.append(f"err = clEnqueueMarkerWithWaitList(command_queue, {len(downloads) + 1}, events, "
+                            f"&kernel{kernel_id}_done);\n" + check_error("Failed to enqueue marker.") +
+                            "    // Submit everything now, so the device works while the host carries on\n"
+                            "    err = clFlush(command_queue);\n" + check_error("Failed to flush queue."))
+        release_buffers.append(f"// The buffers are returned to the pool by opencl_wait{kernel_id}\n"
+                               "    for (cl_uint i = num_dependencies; i < num_waits; i++)\n"
+                               "        clReleaseEvent(waits[i]);\n"
+                               f"    for (int i = 0; i < {len(downloads) + 1}; i++)\n"
+                               "        clReleaseEvent(events[i]);\n")
+    else:
+        template = template.replace("<KERNEL EVENTS>", "0, NULL, &profiled_event" if profile else "0, NULL, NULL")
+        template = template.replace("<FINISH KERNEL>", "    // Block until kernel is finished\n"
+                                    "    err = clFinish(command_queue);\n"
+                                    "    if(err != CL_SUCCESS) {\n"
+                                    "        fprintf(stderr,\"OpenCL Error: Failed to block until queue finished: "
+                                    "%d\\n\", err);\n"
+                                    "        exit(EXIT_FAILURE);\n"
+                                    "    }\n" + (indent_lines(
+                                        f"kernel_profiles[{kernel_id}].launches++;\n" +
+                                        profile_code(f"&kernel_profiles[{kernel_id}].kernel", "profiled_event", "0",
+                                                     True), "    ") if profile else ""))
+
     template = template.replace("<INPUT BUFFERS>", "\n    ".join(buffer_decls))
     template = template.replace("<CREATE BUFFERS>", "\n    ".join(create_buffers))
     template = template.replace("<WRITE BUFFERS>", "\n    ".join(write_buffers))
@@ -69,14 +323,125 @@ def generate_host_function(kernel_id: int, kernel_info: KernelInfo) -> str:
     return template
 
 
-def generate_host_functions(kernels_info: list[KernelInfo], kernel_path: str) -> (list[str], list[str], list[str]):
+def generate_stream_function(kernel_id: int, kernel_info: KernelInfo, options: HostOptions) -> str:
+    visitor = TranslationVisitor()
+    buffers = [(i, arg) for i, arg in enumerate(kernel_info.args) if arg.is_buffer()]
+    code = ""
+    profile = options.profile_results is not None
+    if profile:
+        # The chunks overlap, so their commands are profiled once the last one has finished
+        code += (f"    kernel_profiles[{kernel_id}].launches++;\n"
+                 "    cl_event profiled_event;\n")
+    if kernel_info.dependencies:
+        code += "    " + wait_for_dependencies_code(kernel_info) + "\n\n"
+    code += ("    // Stream the domain through the device in chunks, uploading each chunk while the one before runs\n"
+            "    size_t domain = domain_size0 > 0 ? domain_size0 : 0;\n"
+            "    size_t chunk = domain < STREAM_CHUNK_SIZE ? domain : STREAM_CHUNK_SIZE;\n"
+            "    if (chunk == 0)\n"
+            "        chunk = 1;\n"
+            "    size_t local[1];\n"
+            f"    choose_local_size(local{kernel_id}, 1, &chunk, local, NULL);\n"
+            "    size_t chunks = (domain + chunk - 1) / chunk;\n"
+            "    cl_event uploaded[2] = {NULL, NULL};\n"
+            "    cl_event computed[2] = {NULL, NULL};\n")
+    code += "".join(f"    cl_mem {arg.name}_cl[2];\n" for _, arg in buffers)
+
+    code += "\n    // Create buffers\n    for (int slot = 0; slot < 2; slot++) {\n"
+    for _, arg in buffers:
+        code += "        " + create_buffer_code(f"{arg.name}_cl[slot]", buffer_flags(arg),
+                                               f"chunk * sizeof(*{arg.name})", "        ")
+    code += "    }\n"
+
+    code += "\n    // Set kernel arguments\n"
+    for i, arg in enumerate(kernel_info.args):
+        if not arg.is_buffer():
+            code += (f"    err = clSetKernelArg(kernel{kernel_id}, {i}, sizeof({visitor.visit(arg.type)}), "
+                     f"&{arg.name});\n" + check_error("Failed to set kernel argument."))
+
+    code += ("\n    for (size_t step = 0; step <= chunks; step++) {\n"
+             "        int slot = step % 2;\n"
+             "        if (step < chunks) {\n"
+             "            // Upload the next chunk once the kernel that last used this slot's buffers has finished\n"
+             "            size_t start = step * chunk;\n"
+             "            size_t count = domain - start < chunk ? domain - start : chunk;\n")
+    for _, arg in buffers:
+        if arg.read:
+            code += (f"            err = clEnqueueWriteBuffer(transfer_queue, {arg.name}_cl[slot], CL_FALSE, 0, "
+                     f"count * sizeof(*{arg.name}), {arg.name} + start,\n"
+                     "                                       computed[slot] ? 1 : 0, computed[slot] ? &computed[slot] "
+                     f": NULL, {'&profiled_event' if profile else 'NULL'});\n" +
+                     check_error("Failed to write to buffer.", "            "))
+            if profile:
+                code += indent_lines(defer_profile_code(kernel_id, "writes", "profiled_event",
+                                                        f"count * sizeof(*{arg.name})", True), "            ")
+    code += ("            if (uploaded[slot])\n"
+             "                clReleaseEvent(uploaded[slot]);\n"
+             "            err = clEnqueueMarkerWithWaitList(transfer_queue, 0, NULL, &uploaded[slot]);\n" +
+             check_error("Failed to enqueue marker.", "            ") +
+             "            // Each queue waits on events from the other, which only complete once they are submitted\n"
+             "            err = clFlush(transfer_queue);\n" +
+             check_error("Failed to flush queue.", "            ") +
+             "        }\n"
+             "        if (step > 0) {\n"
+             "            // Run the chunk uploaded last time round and read its results back\n"
+             "            int previous = 1 - slot;\n"
+             "            size_t start = (step - 1) * chunk;\n"
+             "            size_t count = domain - start < chunk ? domain - start : chunk;\n"
+             "            size_t offset[1] = {start};\n"
+             "            size_t global[1] = {(count + local[0] - 1) / local[0] * local[0]};\n")
+    for i, arg in buffers:
+        code += (f"            err = clSetKernelArg(kernel{kernel_id}, {i}, sizeof(cl_mem), "
+                 f"&{arg.name}_cl[previous]);\n" +
+                 check_error("Failed to set kernel argument.", "            "))
+    code += ("            if (computed[previous])\n"
+             "                clReleaseEvent(computed[previous]);\n"
+             f"            err = clEnqueueNDRangeKernel(command_queue, kernel{kernel_id}, 1, offset, global, local, 1, "
+             "&uploaded[previous],\n"
+             "                                         &computed[previous]);\n" +
+             check_error("Failed to enqueue kernel:", "            ") +
+             (indent_lines(defer_profile_code(kernel_id, "kernel", "computed[previous]", "0", False), "            ")
+              if profile else "") +
+             "            err = clFlush(command_queue);\n" +
+             check_error("Failed to flush queue.", "            "))
+    for _, arg in buffers:
+        if arg.written:
+            code += (f"            err = clEnqueueReadBuffer(transfer_queue, {arg.name}_cl[previous], CL_FALSE, 0, "
+                     f"count * sizeof(*{arg.name}), {arg.name} + start,\n"
+                     f"                                      1, &computed[previous], "
+                     f"{'&profiled_event' if profile else 'NULL'});\n" +
+                     check_error("Failed to read from buffer.", "            "))
+            if profile:
+                code += indent_lines(defer_profile_code(kernel_id, "reads", "profiled_event",
+                                                        f"count * sizeof(*{arg.name})", True), "            ")
+    code += ("        }\n"
+             "    }\n"
+             "\n    // Block until the last chunk has been read back\n"
+             "    err = clFinish(transfer_queue);\n" +
+             check_error("Failed to block until queue finished:") +
+             (f"    profile_deferred_events(&kernel_profiles[{kernel_id}]);\n" if profile else "") +
+             "\n    // Free buffers\n"
+             "    for (int slot = 0; slot < 2; slot++) {\n"
+             "        if (uploaded[slot])\n"
+             "            clReleaseEvent(uploaded[slot]);\n"
+             "        if (computed[slot])\n"
+             "            clReleaseEvent(computed[slot]);\n")
+    for _, arg in buffers:
+        code += "        " + release_buffer_code(f"{arg.name}_cl[slot]", "        ")
+    code += "    }\n"
+    return code
+
+
+def generate_host_functions(kernels_info: list[KernelInfo], kernel_path: str,
+                            options: HostOptions) -> (list[str], list[str], list[str]):
     visitor = TranslationVisitor()
     functions = []
     calls = []
     decls = []
     for i, kernel_info in enumerate(kernels_info):
-        func = f"void {kernel_info.name}(int domain_size, "
-        call = f"{kernel_info.name}({kernel_info.domain_size}, "
+        # omp parallel regions have no loop to size them, so they run one work-group's worth of work-items
+        domain_sizes = kernel_info.domain_sizes or [f"local{i}"]
+        func = f"void {kernel_info.name}(" + "".join(f"int domain_size{d}, " for d in range(len(domain_sizes)))
+        call = f"{kernel_info.name}(" + "".join(f"{size}, " for size in domain_sizes)
 
         pointer_derefs = []
         pointer_writes = []
@@ -100,7 +465,11 @@ def generate_host_functions(kernels_info: list[KernelInfo], kernel_path: str) ->
         decl = func + ");\n"
         func += ") {\n    "
         func += ("\n    ".join(pointer_derefs) + "\n") if pointer_derefs else ""
-        func += generate_host_function(i, kernel_info)
+        if kernel_info.streamed:
+            func += generate_stream_function(i, kernel_info, options)
+        else:
+            func += generate_host_function(i, kernel_info, options)
+        func += "".join(f"    opencl_wait{k}();\n" for k in kernel_info.synchronizes)
         func += ("\n    " + "\n    ".join(pointer_writes) + "\n") if pointer_writes else ""
         func += "}\n"
         functions.append(func)
@@ -112,85 +481,253 @@ def generate_host_functions(kernels_info: list[KernelInfo], kernel_path: str) ->
     return functions, calls, decls
 
 
-def process_original_file(file: str, kernels_info: list[KernelInfo], kernel_path: str) -> str:
-    opencl_decls, boilerplate_functions = generate_boilerplate(kernels_info, kernel_path)
-    functions, calls, decls = generate_host_functions(kernels_info, kernel_path)
+def has_host_fallback(kernel_info: KernelInfo) -> bool:
+    # Kernels sharing device buffers with other kernels or a data region always have to run on the device
+    return kernel_info.domain_sizes is not None and not any(arg.resident for arg in kernel_info.args)
+
+
+def generate_data_region_code(region: DataRegionInfo, indent: str, zero_copy: bool = False) -> (str, str):
+    enter_code = ""
+    exit_code = ""
+    for buffer in region.buffers:
+        enter_code += indent + create_buffer_code(buffer.resident, "CL_MEM_READ_WRITE", buffer.size, indent,
+                                                  host_ptr=buffer.name if zero_copy else None)
+        if buffer.read:
+            enter_code += indent + write_buffer_code(buffer.resident, buffer.size, buffer.name, indent,
+                                                     zero_copy=zero_copy)
+        if buffer.written:
+            exit_code += indent + read_buffer_code(buffer.resident, buffer.size, buffer.name, indent,
+                                                   zero_copy=zero_copy)
+        exit_code += indent + release_buffer_code(buffer.resident, indent)
+    return enter_code, exit_code
+
+
+def process_original_file(file: str, kernels_info: list[KernelInfo], kernel_path: str,
+                          data_regions_info: list[DataRegionInfo], options: Optional[HostOptions] = None,
+                          sync_points: Optional[dict[int, list[int]]] = None) -> str:
+    options = options or HostOptions()
+    sync_points = sync_points or {}
+    opencl_decls, boilerplate_functions = generate_boilerplate(kernels_info, data_regions_info, kernel_path,
+                                                               options)
+    functions, calls, decls = generate_host_functions(kernels_info, kernel_path, options)
     decls = [opencl_decls] + decls
     functions = functions + [boilerplate_functions]
     with open(file, "r") as f:
         lines = f.readlines()
-    gaps = []
-    included = [False for _ in kernels_info]
+    source = SourceIndex("".join(lines))
+
+    # Each line replaced by a kernel launch maps to its kernel, from the pragma to the end of the loop or block
+    kernel_at_line: list[Optional[int]] = [None for _ in lines]
+    kernel_ends = []
     for k, ki in enumerate(kernels_info):
-        start = ki.src_start_line #+ 1
-        num_open_braces = 0
-        ended = False
-        end = -1
-        for i, line in enumerate(lines[start:]):
-            for char in line:
-                if char == "{":
-                    num_open_braces += 1
-                elif char == "}":
-                    num_open_braces -= 1
-                if num_open_braces == -1:
-                    end = start + i
-                    ended = True
-                    break
-            if ended:
-                break
-        gaps.append((k, ki.src_start_line-1, end))
+        start, end = source.statement_lines(ki.src_start_line)
+        for i in range(start - 2, end):
+            kernel_at_line[i] = k
+        kernel_ends.append(end - 1)
+    included = [False for _ in kernels_info]
+
+    region_starts = {}
+    region_ends = {}
+    for region in data_regions_info:
+        start = region.src_start_line - 1
+        indent = lines[start][:len(lines[start]) - len(lines[start].lstrip())]
+        enter_code, exit_code = generate_data_region_code(region, indent, options.zero_copy)
+        region_starts[start] = enter_code
+        _, end = source.statement_lines(region.src_start_line + 1)
+        region_ends[end - 1] = region_ends.get(end - 1, "") + exit_code
+
+    main_start, main_open, main_close = (line - 1 for line in source.find_function("main") or (0, 0, 0))
 
     new_lines = []
-    in_main = False
     for i, line in enumerate(lines):
+        # Asynchronous kernels are waited for just before the host next uses their arrays
+        if i + 1 in sync_points:
+            indent = line[:len(line) - len(line.lstrip())]
+            new_lines.append("".join(f"{indent}opencl_wait{k}();\n" for k in sync_points[i + 1]))
+        if i in region_starts:
+            new_lines.append(region_starts[i])
+            continue
+        k = kernel_at_line[i]
+        if k is not None:
+            fallback = has_host_fallback(kernels_info[k])
+            if not included[k]:
+                if fallback:
+                    domain = " * ".join(f"({size})" for size in kernels_info[k].domain_sizes)
+                    new_lines.append(f"    if ((long) {domain} >= offload_threshold{k}) {{\n"
+                                     f"        {calls[k]}"
+                                     "    } else {\n" +
+                                     "".join(f"        opencl_wait{j}();\n"
+                                             for j in kernels_info[k].dependencies))
+                else:
+                    new_lines.append("    " + calls[k])
+                included[k] = True
+            if fallback:
+                # coarsen isn't an OpenMP clause, so it can't be left for the compiler to see
+                new_lines.append(re.sub(r"\s*coarsen\s*\([^)]*\)", "", line) if line.lstrip().startswith("#pragma")
+                                 else line)
+                if i == kernel_ends[k]:
+                    new_lines.append("    }\n")
+            continue
         if line.startswith("#pragma omp"):
             continue
         if i == 0:
             new_lines.append("#include <CL/cl.h>\n")
+            # The program binary cache checks who owns its files and writes them with mkstemp
+            new_lines.append("#include <string.h>\n#include <sys/stat.h>\n#include <unistd.h>\n")
+            if options.autotune_results is not None:
+                new_lines.append("#include <time.h>\n")
         if line.startswith('#'):
             new_lines.append(line)
             continue
-        if line.find("main(") >= 0:
-            in_main = True
+        if i == main_start:
             new_lines.append("".join(decls) + "\n")
-        if line == "}\n" and in_main:
-            in_main = False
+        if i == main_close:
             new_lines.append("\topencl_teardown();\n")
-        ignored = False
-        for j, gap in enumerate(gaps):
-            k, start, end = gap
-            if start-1 <= i <= end:
-                ignored = True
-                if not included[k]:
-                    new_lines.append("    " + calls[k])
-                    included[k] = True
-        if not ignored:
-            new_lines.append(line)
-            if line.find("main(") >= 0:
-                new_lines.append("\topencl_setup();\n")
+        new_lines.append(line)
+        if i == main_open:
+            new_lines.append("\topencl_setup();\n")
+        if i in region_ends:
+            new_lines.append(region_ends[i])
 
     return "".join(new_lines) + "".join(functions)
 
 
-def generate_boilerplate(kernels_info: list[KernelInfo], kernel_path: str) -> (str, str):
+def c_string_literal(text: str, indent: str = "    ") -> str:
+    escaped = text.replace("\\", "\\\\").replace("\"", "\\\"").replace("\t", "\\t")
+    lines = escaped.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return "\n".join(indent + f'"{line}\\n"' for line in lines) if lines else indent + '""'
+
+
+def generate_boilerplate(kernels_info: list[KernelInfo], data_regions_info: list[DataRegionInfo],
+                         kernel_path: str, options: HostOptions) -> (str, str):
     opencl_decls = ("cl_device_id device_id;\n"
                     "cl_context context;\n"
                     "cl_command_queue command_queue;\n"
                     "cl_program program;\n"
                     "cl_int err;\n"
                     "void opencl_setup();\n"
-                    "void opencl_teardown();\n")
+                    "void opencl_teardown();\n"
+                    "#define BUFFER_POOL_CAPACITY 64\n"
+                    "#define BUFFER_POOL_SLACK 2\n"
+                    "struct buffer_pool_entry {\n"
+                    "    cl_mem buffer;\n"
+                    "    size_t size;\n"
+                    "    cl_mem_flags flags;\n"
+                    "    int in_use;\n"
+                    "};\n"
+                    "struct buffer_pool_entry buffer_pool[BUFFER_POOL_CAPACITY];\n"
+                    "int buffer_pool_count;\n"
+                    "cl_mem buffer_pool_acquire(cl_mem_flags flags, size_t size, cl_int *errcode_ret);\n"
+                    "cl_int buffer_pool_release(cl_mem buffer);\n"
+                    "void buffer_pool_trim();\n"
+                    "void buffer_pool_drain();\n"
+                    "size_t max_work_item_sizes[3];\n"
+                    "void choose_local_size(size_t max_work_group_size, cl_uint work_dim, size_t *global, "
+                    "size_t *local,\n"
+                    "                       const size_t *preferred);\n")
+    if options.kernel_source is not None:
+        opencl_decls += ("#define KERNEL_SOURCE_EMBEDDED\n"
+                         "const char kernel_source[] =\n" + c_string_literal(options.kernel_source) + ";\n")
+    if any(kernel_info.streamed for kernel_info in kernels_info):
+        opencl_decls += ("cl_command_queue transfer_queue;\n"
+                         f"#define STREAM_CHUNK_SIZE {options.stream_chunk_size}\n")
+    if options.zero_copy:
+        opencl_decls += "int zero_copy;\n"
+    profile = options.profile_results is not None and len(kernels_info) > 0
+    if profile:
+        opencl_decls += (f"#define PROFILE_RESULTS {json.dumps(options.profile_results)}\n"
+                         f"#define PROFILE_KERNELS {len(kernels_info)}\n"
+                         "struct profile_times {\n"
+                         "    cl_ulong commands;\n"
+                         "    cl_ulong bytes;\n"
+                         "    cl_ulong queued;\n"
+                         "    cl_ulong submitted;\n"
+                         "    cl_ulong running;\n"
+                         "};\n"
+                         "struct profile_deferred {\n"
+                         "    struct profile_times *times;\n"
+                         "    cl_event event;\n"
+                         "    size_t bytes;\n"
+                         "};\n"
+                         "struct kernel_profile {\n"
+                         "    const char *name;\n"
+                         "    cl_ulong launches;\n"
+                         "    struct profile_times writes;\n"
+                         "    struct profile_times kernel;\n"
+                         "    struct profile_times reads;\n"
+                         "    struct profile_deferred *deferred;\n"
+                         "    size_t num_deferred;\n"
+                         "    size_t deferred_capacity;\n"
+                         "};\n"
+                         "struct kernel_profile kernel_profiles[PROFILE_KERNELS] = {" +
+                         ", ".join(f'{{"{kernel_info.name}"}}' for kernel_info in kernels_info) + "};\n"
+                         "void profile_event(struct profile_times *times, cl_event event, size_t bytes);\n"
+                         "void profile_defer(struct kernel_profile *profile, struct profile_times *times, "
+                         "cl_event event,\n"
+                         "                   size_t bytes);\n"
+                         "void profile_deferred_events(struct kernel_profile *profile);\n"
+                         "void profile_write_results();\n")
+    if options.autotune_results is not None:
+        opencl_decls += ("#define AUTOTUNE_RUNS 5\n"
+                         f"#define AUTOTUNE_RESULTS {json.dumps(options.autotune_results)}\n"
+                         "void autotune_kernel(cl_kernel kernel, size_t max_work_group_size, cl_uint work_dim, "
+                         "const size_t *domain,\n"
+                         "                     size_t *best_local, cl_uint num_buffers, const cl_mem *buffers, "
+                         "const size_t *sizes);\n"
+                         "void autotune_write_results();\n")
 
     with open("setup.c.template", "r") as f:
         setup_function = f.read()
 
     setup_function = setup_function.replace("<SOURCE FILEPATH>", f"\"{kernel_path}\"")
+    asynchronous = any(kernel_info.asynchronous for kernel_info in kernels_info)
+    queue_properties = (["CL_QUEUE_OUT_OF_ORDER_EXEC_MODE_ENABLE"] if asynchronous else []) + \
+                       (["CL_QUEUE_PROFILING_ENABLE"] if profile else [])
+    setup_function = setup_function.replace("<QUEUE PROPERTIES>", " | ".join(queue_properties) or "0")
+    setup_function = setup_function.replace("<FALLBACK QUEUE PROPERTIES>",
+                                            "CL_QUEUE_PROFILING_ENABLE" if profile else "0")
 
     create_kernels = ""
     release_kernels = ""
+    autotuned = []
+    if any(kernel_info.streamed for kernel_info in kernels_info):
+        # Streamed kernels move data on their own queue so transfers overlap with kernels
+        create_kernels += ("\ttransfer_queue = clCreateCommandQueue(context, device_id, 0, &err);\n"
+                           "\tif (!transfer_queue) {\n"
+                           '\t\tfprintf(stderr, "OpenCL Error: Failed to create transfer queue: %d!\\n", err);\n'
+                           "\t\texit(EXIT_FAILURE);\n"
+                           "\t}\n")
+        release_kernels += ("\terr = clReleaseCommandQueue(transfer_queue);\n"
+                            "\tif (err != CL_SUCCESS) {\n"
+                            '\t\tfprintf(stderr, "OpenCL Error: Failed to release transfer queue: %d!\\n", err);\n'
+                            "\t\texit(EXIT_FAILURE);\n"
+                            "\t}\n")
+    if options.zero_copy:
+        # Integrated devices work on host memory directly, OPENCL_ZERO_COPY=0 or 1 overrides the query
+        create_kernels += ("\tcl_bool host_unified_memory = CL_FALSE;\n"
+                           "\tclGetDeviceInfo(device_id, CL_DEVICE_HOST_UNIFIED_MEMORY, sizeof(host_unified_memory), "
+                           "&host_unified_memory, NULL);\n"
+                           '\tconst char *zero_copy_override = getenv("OPENCL_ZERO_COPY");\n'
+                           "\tzero_copy = zero_copy_override ? atoi(zero_copy_override) != 0 : host_unified_memory;\n")
     for i, kernel_info in enumerate(kernels_info):
         opencl_decls += (f"cl_kernel kernel{i};\n"
                          f"size_t local{i};\n")
+        if kernel_info.asynchronous:
+            opencl_decls += f"cl_event kernel{i}_done;\n"
+            opencl_decls += "".join(f"cl_mem {kernel_buffer(i, kernel_info, arg)};\n" for arg in kernel_info.args
+                                    if arg.is_buffer() and not arg.resident)
+            opencl_decls += f"void opencl_wait{i}();\n"
+        if options.autotune_results is not None and kernel_info.domain_sizes is not None and \
+                not any(arg.reduction for arg in kernel_info.args):
+            opencl_decls += (f"int autotuned{i};\n"
+                             f"size_t autotuned_local{i}[3];\n")
+            autotuned.append((i, kernel_info))
+        if has_host_fallback(kernel_info):
+            opencl_decls += f"long offload_threshold{i};\n"
+            create_kernels += f'\toffload_threshold{i} = offload_threshold("{kernel_info.name}", ' \
+                              f'{kernel_info.offload_threshold});\n'
         create_kernels += (
             f'\tkernel{i} = clCreateKernel(program, "{kernel_info.name}", &err);\n'
             f"\tif (!kernel{i} || err != CL_SUCCESS)\n"
@@ -213,10 +750,77 @@ def generate_boilerplate(kernels_info: list[KernelInfo], kernel_path: str) -> (s
         )
     setup_function = setup_function.replace("<CREATE KERNELS>", create_kernels)
 
+    resident_buffers = [arg.resident for kernel_info in kernels_info for arg in kernel_info.args if arg.resident] + \
+                       [buffer.resident for region in data_regions_info for buffer in region.buffers]
+    for buffer in dict.fromkeys(resident_buffers):
+        opencl_decls += f"cl_mem {buffer};\n"
+
     with open("teardown.c.template", "r") as f:
         teardown_function = f.read()
 
+    if options.autotune_results is not None:
+        release_kernels += "\tautotune_write_results();\n"
+    if profile:
+        release_kernels += "\tprofile_write_results();\n"
     teardown_function = teardown_function.replace("<RELEASE KERNELS>", release_kernels)
 
-    boilerplate_functions = setup_function + teardown_function
+    with open("buffer_pool.c.template", "r") as f:
+        buffer_pool_functions = f.read()
+
+    with open("work_group.c.template", "r") as f:
+        work_group_functions = f.read()
+
+    boilerplate_functions = setup_function + teardown_function + buffer_pool_functions + work_group_functions
+    for i, kernel_info in enumerate(kernels_info):
+        if kernel_info.asynchronous:
+            boilerplate_functions += generate_wait_function(i, kernel_info, profile)
+    if options.autotune_results is not None:
+        with open("autotune.c.template", "r") as f:
+            boilerplate_functions += f.read()
+        boilerplate_functions += generate_autotune_results(autotuned)
+    if profile:
+        with open("profile.c.template", "r") as f:
+            boilerplate_functions += f.read()
     return opencl_decls, boilerplate_functions
+
+
+def generate_wait_function(kernel_id: int, kernel_info: KernelInfo, profile: bool = False) -> str:
+    # Safe to call when the kernel ran on the host or has already been waited for
+    function = (f"void opencl_wait{kernel_id}() {{\n"
+                f"    if (!kernel{kernel_id}_done)\n"
+                "        return;\n"
+                f"    err = clWaitForEvents(1, &kernel{kernel_id}_done);\n" +
+                check_error("Failed to wait for events.") +
+                (f"    profile_deferred_events(&kernel_profiles[{kernel_id}]);\n" if profile else "") +
+                f"    clReleaseEvent(kernel{kernel_id}_done);\n"
+                f"    kernel{kernel_id}_done = NULL;\n")
+    for arg in kernel_info.args:
+        if arg.is_buffer() and arg.release:
+            function += "    " + release_buffer_code(kernel_buffer(kernel_id, kernel_info, arg))
+    function += "}\n"
+    return function
+
+
+def generate_autotune_results(autotuned: list[(int, KernelInfo)]) -> str:
+    # Written as JSON so it can be passed back to the translator with --work-group-sizes
+    function = ("void autotune_write_results() {\n"
+                "    FILE *results = fopen(AUTOTUNE_RESULTS, \"w\");\n"
+                "    if (!results) {\n"
+                "        fprintf(stderr,\"Failed to write autotuning results to %s\\n\", AUTOTUNE_RESULTS);\n"
+                "        return;\n"
+                "    }\n"
+                "    const char *separator = \"\";\n"
+                "    fprintf(results, \"{\");\n")
+    for i, kernel_info in autotuned:
+        work_dim = len(kernel_info.domain_sizes)
+        sizes = ", ".join("%zu" for _ in range(work_dim))
+        values = ", ".join(f"autotuned_local{i}[{d}]" for d in range(work_dim))
+        function += (f"    if (autotuned{i}) {{\n"
+                     f"        fprintf(results, \"%s\\n    \\\"{kernel_info.name}\\\": [{sizes}]\", separator,\n"
+                     f"                {values});\n"
+                     "        separator = \",\";\n"
+                     "    }\n")
+    function += ("    fprintf(results, \"\\n}\\n\");\n"
+                 "    fclose(results);\n"
+                 "}\n")
+    return function
@@ -0,0 +1,76 @@
+import os
+import pickle
+import re
+from typing import Optional
+from pycparser import c_ast, c_parser
+
+from . import cache
+
+LINE_MARKER = re.compile(r'#\s*(?:line\s+)?\d+\s+"([^"]*)"')
+
+
+class PreludeParser(c_parser.CParser):
+    def supports_prelude(self) -> bool:
+        # Parsing after a prelude relies on the internals of pycparser's PLY based parser, which later versions
+        # may not have
+        return hasattr(self, "_scope_stack") and hasattr(self, "cparser") and \
+            hasattr(getattr(self, "clex", None), "reset_lineno")
+
+    def parse_prelude(self, text: str, filename: str) -> tuple[c_ast.FileAST, dict[str, bool]]:
+        ast = self.parse(text, filename)
+        # The file scope says which names are typedefs, which the rest of the file can't be parsed without
+        return ast, dict(self._scope_stack[0])
+
+    def parse_after_prelude(self, text: str, filename: str, scope: dict[str, bool]) -> c_ast.FileAST:
+        # The same as parse, except that the file scope starts with what the prelude declared
+        self.clex.filename = filename
+        self.clex.reset_lineno()
+        self._scope_stack = [dict(scope)]
+        self._last_yielded_token = None
+        return self.cparser.parse(input=text, lexer=self.clex)
+
+
+def in_prelude(path: Optional[str], include_dirs: list[str]) -> bool:
+    if path is None or path.startswith("<"):
+        return True
+    path = os.path.normpath(path)
+    return any(path.startswith(os.path.normpath(directory) + os.sep) for directory in include_dirs)
+
+
+def split_prelude(text: str, include_dirs: list[str]) -> tuple[str, str]:
+    # The prelude is what the preprocessor put before the first line of code from outside include_dirs. Markers and
+    # blank lines from other files are left out of it, so files including the same headers share one prelude. The
+    # rest starts at a line marker, so it still knows the file and line it came from
+    prelude = []
+    current = None
+    split = 0
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        marker = LINE_MARKER.match(line)
+        if marker:
+            current = marker.group(1)
+            split = offset
+        elif line.strip() and not in_prelude(current, include_dirs):
+            break
+        if in_prelude(current, include_dirs):
+            prelude.append(line)
+        offset += len(line)
+    else:
+        split = offset
+    return "".join(prelude), text[split:]
+
+
+def parse(parser: PreludeParser, text: str, filename: str, include_dirs: list[str],
+          translation_cache: Optional[cache.TranslationCache]) -> c_ast.FileAST:
+    prelude, code = split_prelude(text, include_dirs)
+    if translation_cache is None or not prelude or not parser.supports_prelude():
+        return parser.parse(text, filename)
+    key = cache.prelude_key(prelude)
+    data = translation_cache.get_prelude(key)
+    if data is None:
+        prelude_ast, scope = parser.parse_prelude(prelude, filename)
+        translation_cache.put_prelude(key, pickle.dumps((prelude_ast, scope)))
+    else:
+        prelude_ast, scope = pickle.loads(data)
+    code_ast = parser.parse_after_prelude(code, filename, scope)
+    return c_ast.FileAST(prelude_ast.ext + code_ast.ext)
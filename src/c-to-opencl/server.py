@@ -0,0 +1,61 @@
+import io
+import os
+import signal
+import socket
+import sys
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+
+from . import client
+from . import driver
+
+
+def handle_request(connection: socket.socket) -> None:
+    request = client.receive_message(connection)
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    outputs = {}
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            # Relative paths and the templates are found from the client's working directory
+            os.chdir(request["cwd"])
+            argparser = driver.build_argparser()
+            status = driver.run(argparser, argparser.parse_args(request["argv"]), outputs)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+    client.send_message(connection, {"status": status, "stdout": stdout.getvalue(), "stderr": stderr.getvalue(),
+                                     "outputs": outputs})
+
+
+def serve(socket_path: str) -> None:
+    driver.get_parser()
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(socket_path)
+        server.listen()
+        # Finished request handlers are reaped by the kernel
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        # Being terminated removes the socket like an interrupt does
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print(f"Serving translations on {socket_path}", file=sys.stderr)
+        try:
+            while True:
+                connection, _ = server.accept()
+                # Requests change to the client's directory and capture its output, which are per process, so each
+                # is handled in a child forked from the warm server, which also lets requests run in parallel
+                if os.fork() == 0:
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    server.close()
+                    try:
+                        handle_request(connection)
+                    finally:
+                        os._exit(0)
+                connection.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
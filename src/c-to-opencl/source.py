@@ -0,0 +1,99 @@
+import re
+from bisect import bisect_left
+from typing import Optional
+
+# Comments, string and character literals and preprocessor lines are matched whole, so braces inside them are
+# never mistaken for the program's own
+TOKEN_PATTERN = re.compile(r"""
+    (?P<directive>^[ \t]*\#(?:\\\n|[^\n])*)
+  | (?P<space>[^\S\n]+|\n)
+  | (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<literal>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<word>\w+)
+  | (?P<punctuation>.)
+""", re.MULTILINE | re.DOTALL | re.VERBOSE)
+
+OPENING = {"(": ")", "[": "]", "{": "}"}
+CLOSING = {")", "]", "}"}
+
+
+# pycparser only records where a node starts, so the tokens of the source and their matching brackets are kept to
+# find the line each statement ends on
+class SourceIndex:
+    texts: list[str]
+    lines: list[int]
+    depths: list[int]  # braces enclosing each token
+    matches: dict[int, int]  # bracket token to the token that closes or opens it
+
+    def __init__(self, text: str):
+        self.texts = []
+        self.lines = []
+        self.depths = []
+        self.matches = {}
+        line = 1
+        depth = 0
+        open_brackets = []
+        for match in TOKEN_PATTERN.finditer(text):
+            token = match.group()
+            if match.lastgroup in ("word", "punctuation"):
+                if token in CLOSING and open_brackets and OPENING[self.texts[open_brackets[-1]]] == token:
+                    opening = open_brackets.pop()
+                    self.matches[opening] = len(self.texts)
+                    self.matches[len(self.texts)] = opening
+                    depth -= token == "}"
+                elif token in OPENING:
+                    open_brackets.append(len(self.texts))
+                self.texts.append(token)
+                self.lines.append(line)
+                self.depths.append(depth)
+                depth += token == "{"
+            line += token.count("\n")
+
+    def first_token_from(self, line: int) -> Optional[int]:
+        i = bisect_left(self.lines, line)
+        return i if i < len(self.texts) else None
+
+    def text(self, i: int) -> str:
+        return self.texts[i] if 0 <= i < len(self.texts) else ""
+
+    def statement_end(self, i: int) -> int:
+        # Only the statements that can contain others are told apart, anything else runs to its semicolon
+        token = self.text(i)
+        if token == "{":
+            return self.matches.get(i, len(self.texts) - 1)
+        if token in ("for", "while", "switch") and i + 1 in self.matches:
+            return self.statement_end(self.matches[i + 1] + 1)
+        if token == "if" and i + 1 in self.matches:
+            end = self.statement_end(self.matches[i + 1] + 1)
+            return self.statement_end(end + 2) if self.text(end + 1) == "else" else end
+        if token == "do":
+            end = self.statement_end(i + 1)
+            if self.text(end + 1) == "while" and end + 2 in self.matches:
+                return self.statement_end(self.matches[end + 2] + 1)
+            return end
+        while i < len(self.texts) - 1 and self.texts[i] != ";":
+            if self.texts[i] in CLOSING:
+                return i - 1
+            i = self.matches.get(i, i) + 1
+        return i
+
+    def statement_lines(self, line: int) -> Optional[tuple[int, int]]:
+        # First and last line of the statement starting on or after a line
+        i = self.first_token_from(line)
+        if i is None:
+            return None
+        return self.lines[i], self.lines[self.statement_end(i)]
+
+    def find_function(self, name: str) -> Optional[tuple[int, int, int]]:
+        # Lines a function definition starts on, opens its body on and closes its body on
+        for i, token in enumerate(self.texts):
+            if token != name or self.depths[i] != 0 or self.text(i + 1) != "(" or i + 1 not in self.matches:
+                continue
+            body = self.matches[i + 1] + 1
+            if self.text(body) != "{":
+                continue
+            start = i
+            while start > 0 and self.texts[start - 1] not in (";", "}"):
+                start -= 1
+            return self.lines[start], self.lines[body], self.lines[self.matches.get(body, len(self.texts) - 1)]
+        return None
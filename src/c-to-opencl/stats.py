@@ -0,0 +1,70 @@
+import resource
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pycparser import c_ast
+from .prelude import in_prelude
+from .translate import TranslationResult
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class NodeCounter(c_ast.NodeVisitor):
+    counts: Counter
+    include_dirs: list[str]
+
+    def __init__(self, include_dirs: list[str]):
+        self.counts = Counter()
+        self.include_dirs = include_dirs
+
+    def visit_FileAST(self, node: c_ast.Node) -> None:
+        # Declarations from the fake libc headers are never translated, so only the input's own are counted
+        self.counts[type(node).__name__] += 1
+        for child in node:
+            if not in_prelude(child.coord.file if child.coord else None, self.include_dirs):
+                self.visit(child)
+
+    def generic_visit(self, node: c_ast.Node) -> None:
+        self.counts[type(node).__name__] += 1
+        for child in node:
+            self.visit(child)
+
+
+class TranslationStats:
+    phases: dict[str, dict[str, float]]
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        # Tracing allocations would slow down the phases being timed, so memory is the amount each phase raised the
+        # process's peak resident size by. Phases that stay under an earlier peak show none, and the cpp subprocess
+        # isn't included
+        peak = peak_rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = {"wall_time_s": time.perf_counter() - start,
+                                 "peak_memory_increase_bytes": peak_rss_bytes() - peak}
+
+    def report(self, ast: c_ast.Node, result: TranslationResult, include_dirs: list[str]) -> dict:
+        counter = NodeCounter(include_dirs)
+        counter.visit(ast)
+        return {
+            "phases": self.phases,
+            "ast_nodes": sum(counter.counts.values()),
+            "ast_nodes_by_type": dict(counter.counts.most_common()),
+            "omp_kernels": len(result.kernels_info),
+            "omp_data_regions": len(result.data_regions_info),
+            "kernels_reused": result.kernels_reused,
+            "helper_functions": result.functions_generated,
+            "structs": sorted(result.structs_generated),
+            "typedefs": sorted(result.typedefs_generated),
+        }
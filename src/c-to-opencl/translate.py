@@ -1,7 +1,38 @@
-from dataclasses import dataclass
+import hashlib
+import json
+import re
+from dataclasses import dataclass, field
 from typing import Optional
 from pycparser import c_ast
 
+from . import cache
+
+
+REDUCTION_OPERATORS = {"+", "-", "*", "&", "|", "^", "&&", "||", "min", "max"}
+# Every other operator is idempotent, so private copies can start from the original value instead
+REDUCTION_IDENTITIES = {"+": "0", "-": "0", "*": "1", "^": "0"}
+
+
+def reduction_combine(op: str, left: str, right: str) -> str:
+    if op == "min":
+        return f"({left} < {right} ? {left} : {right})"
+    elif op == "max":
+        return f"({left} > {right} ? {left} : {right})"
+    elif op == "-":
+        # Partial results of a - reduction are added together, as in OpenMP
+        return f"({left} + {right})"
+    return f"({left} {op} {right})"
+
+
+def parse_reduction_clauses(pragma: str) -> dict[str, str]:
+    reductions = {}
+    for op, names in re.findall(r"reduction\s*\(\s*([^:\s]+)\s*:([^)]*)\)", pragma):
+        if op not in REDUCTION_OPERATORS:
+            raise ValueError(f"Unsupported reduction operator '{op}' in '#pragma {pragma}'")
+        for name in names.split(","):
+            reductions[name.strip()] = op
+    return reductions
+
 
 class TranslationVisitor(c_ast.NodeVisitor):
     level_of_indentation: int
@@ -10,12 +41,21 @@ class TranslationVisitor(c_ast.NodeVisitor):
     expand_structs: bool
     declared_in_omp: set[str]
     undeclared_in_omp: set[str]
+    read_in_omp: set[str]
+    written_in_omp: set[str]
     function_calls: set[str]
     structs: set[str]
     new_typedefs: set[str]
     typedefs_used: set[str]
     renamed_variables: dict[str, str]
-    domain_size: Optional[str]
+    domain_sizes: Optional[list[str]]
+    collapse: int
+    loop_bounds: dict[str, str]
+    whole_writes: dict[str, set[str]]
+    conditional_depth: int
+    assignment_target: Optional[c_ast.Node]
+    reductions: dict[str, str]
+    output: list[str]
 
     builtin_types = {"bool", "char", "unsigned", "char", "short", "int", "long", "float", "double", "size_t",
                      "ptrdiff_t", "intptr_t", "uintptr_t", "void"}
@@ -24,69 +64,92 @@ class TranslationVisitor(c_ast.NodeVisitor):
                       "__kernel", "__read_only", "__write_only", "__read_write", "__uniform", "__pipe"}
 
     def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
         self.level_of_indentation = 0
         self.omp_mode = False
         self.omp_parallel_for = False
         self.expand_structs = False
         self.declared_in_omp = set()
         self.undeclared_in_omp = set()
+        self.read_in_omp = set()
+        self.written_in_omp = set()
         self.function_calls = set()
         self.structs = set()
         self.new_typedefs = set()
         self.typedefs_used = set()
         self.renamed_variables = {}
-        self.domain_size = None
-
-    def translate_omp_parallel(self, node: c_ast.Node) -> str:
+        self.domain_sizes = None
+        self.collapse = 1
+        self.coarsening = 1
+        self.coarsening_mode = "strided"
+        self.vector_width = 1
+        self.streamed_arrays = set()
+        self.loop_bounds = {}
+        self.whole_writes = {}
+        self.conditional_depth = 0
+        self.assignment_target = None
+        self.reductions = {}
+        self.output = []
+
+    def emit(self, text: str) -> None:
+        self.output.append(text)
+
+    def render(self, node: c_ast.Node) -> str:
+        # Statements write straight to the output buffer and return "", while expressions return their text, so
+        # everything a visit produced is cut back out of the buffer here
+        start = len(self.output)
+        text = self.visit(node)
+        rendered = "".join(self.output[start:]) + text
+        del self.output[start:]
+        return rendered
+
+    def use_private_reduction_variables(self, reductions: Optional[dict[str, str]]) -> None:
+        self.reductions = reductions or {}
+        for name in self.reductions:
+            self.renamed_variables[name] = f"{name}_private"
+
+    def translate_omp_parallel(self, node: c_ast.Node, reductions: Optional[dict[str, str]] = None) -> str:
+        self.reset()
         self.omp_mode = True
-        self.omp_parallel_for = False
-        self.expand_structs = False
-        self.level_of_indentation = 0
-        self.declared_in_omp = set()
-        self.undeclared_in_omp = set()
-        self.function_calls = set()
-        self.structs = set()
-        self.new_typedefs = set()
-        self.typedefs_used = set()
-        self.renamed_variables = {}
-        self.domain_size = None
-        return self.visit(node)
-
-    def translate_omp_parallel_for(self, node: c_ast.Node) -> (int, str):
+        self.use_private_reduction_variables(reductions)
+        return self.render(node)
+
+    def translate_omp_parallel_for(self, node: c_ast.Node, reductions: Optional[dict[str, str]] = None,
+                                   collapse: int = 1, coarsening: int = 1,
+                                   coarsening_mode: str = "strided", vector_width: int = 1,
+                                   streamed_arrays: Optional[set[str]] = None) -> (list[str], str):
+        self.reset()
         self.omp_mode = True
         self.omp_parallel_for = True
-        self.expand_structs = False
-        self.level_of_indentation = 0
-        self.declared_in_omp = set()
-        self.undeclared_in_omp = set()
-        self.function_calls = set()
-        self.structs = set()
-        self.new_typedefs = set()
-        self.typedefs_used = set()
-        self.renamed_variables = {}
-        self.domain_size = None
+        self.collapse = collapse
+        self.coarsening = coarsening
+        self.coarsening_mode = coarsening_mode
+        self.vector_width = vector_width
+        self.streamed_arrays = streamed_arrays or set()
+        self.use_private_reduction_variables(reductions)
 
-        kernel = self.visit(node)
-        return self.domain_size, kernel
+        kernel = self.render(node)
+        return self.domain_sizes, kernel
 
     def translate_function(self, node: c_ast.Node, renamed: dict[str, str]) -> str:
-        self.omp_mode = False
-        self.omp_parallel_for = False
-        self.expand_structs = False
-        self.level_of_indentation = 0
-        self.declared_in_omp = set()
-        self.undeclared_in_omp = set()
-        self.function_calls = set()
-        self.structs = set()
-        self.new_typedefs = set()
-        self.typedefs_used = set()
+        self.reset()
         self.renamed_variables = renamed
-        self.domain_size = None
-        return self.visit(node)
+        return self.render(node)
 
     def get_omp_kernel_args(self) -> set[str]:
         return self.undeclared_in_omp
 
+    def get_omp_reads(self) -> set[str]:
+        return self.read_in_omp
+
+    def get_omp_writes(self) -> set[str]:
+        return self.written_in_omp
+
+    def get_whole_writes(self) -> dict[str, set[str]]:
+        return self.whole_writes
+
     def get_function_calls(self) -> set[str]:
         return self.function_calls
 
@@ -100,35 +163,198 @@ class TranslationVisitor(c_ast.NodeVisitor):
         return self.renamed_variables
 
     def generate_struct_def(self, node: c_ast.Node) -> str:
-        self.omp_mode = False
-        self.omp_parallel_for = False
-        self.level_of_indentation = 0
-        self.declared_in_omp = set()
-        self.undeclared_in_omp = set()
-        self.function_calls = set()
-        self.structs = set()
-        self.new_typedefs = set()
-        self.typedefs_used = set()
-        self.renamed_variables = {}
+        self.reset()
         self.expand_structs = True
-        self.domain_size = None
         return self.visit(node)
 
     def generate_typedefs(self, node: c_ast.Node) -> str:
-        self.omp_mode = False
-        self.omp_parallel_for = False
-        self.level_of_indentation = 0
-        self.declared_in_omp = set()
-        self.undeclared_in_omp = set()
-        self.function_calls = set()
-        self.structs = set()
-        self.new_typedefs = set()
-        self.typedefs_used = set()
-        self.renamed_variables = {}
+        self.reset()
         self.expand_structs = True
-        self.domain_size = None
         return self.visit(node)
 
+    def find_base_variable(self, node: c_ast.Node) -> Optional[c_ast.ID]:
+        while type(node) is not c_ast.ID:
+            if type(node) is c_ast.ArrayRef or type(node) is c_ast.StructRef:
+                node = node.name
+            elif type(node) is c_ast.UnaryOp and node.op == "*" or type(node) is c_ast.Cast:
+                node = node.expr
+            else:
+                return None
+        return node
+
+    def record_write(self, node: c_ast.Node, bound: Optional[str] = None) -> None:
+        # A write only replaces the previous contents of a buffer if every work-item unconditionally writes its own
+        # element of a loop running from 0 to bound, so anything else counts as a read too. Whether bound covers the
+        # whole buffer is left to whoever knows its size
+        base = self.find_base_variable(node)
+        if not self.omp_mode or base is None:
+            return
+        self.written_in_omp.add(base.name)
+        if bound is None:
+            self.read_in_omp.add(base.name)
+        else:
+            self.whole_writes.setdefault(base.name, set()).add(bound)
+
+    def find_pointer_operands(self, node: c_ast.Node) -> list[c_ast.Node]:
+        # Expressions that may evaluate to a pointer into one of the variables, as in foo(a + i)
+        if type(node) is c_ast.Cast:
+            return self.find_pointer_operands(node.expr)
+        if type(node) is c_ast.BinaryOp and node.op in ("+", "-"):
+            return self.find_pointer_operands(node.left) + self.find_pointer_operands(node.right)
+        if type(node) is c_ast.TernaryOp:
+            return self.find_pointer_operands(node.iftrue) + self.find_pointer_operands(node.iffalse)
+        return [node] if type(node) is c_ast.ID else []
+
+    def canonical_loop_index(self, node: c_ast.Node) -> Optional[str]:
+        # Only loops of the form for (i = 0; i < n; i++) map directly onto an NDRange dimension
+        if type(node) is not c_ast.For or type(node.cond) is not c_ast.BinaryOp or node.cond.op != "<" or \
+                type(node.cond.left) is not c_ast.ID:
+            return None
+        index = node.cond.left.name
+        init = node.init
+        if type(init) is c_ast.DeclList and len(init.decls) == 1:
+            init = init.decls[0]
+        if type(init) is c_ast.Decl and init.name == index:
+            start = init.init
+        elif type(init) is c_ast.Assignment and init.op == "=" and type(init.lvalue) is c_ast.ID \
+                and init.lvalue.name == index:
+            start = init.rvalue
+        else:
+            return None
+        if type(start) is not c_ast.Constant or start.value != "0":
+            return None
+        step = node.next
+        if type(step) is c_ast.UnaryOp and step.op in ("++", "p++") and type(step.expr) is c_ast.ID and \
+                step.expr.name == index:
+            return index
+        if type(step) is c_ast.Assignment and step.op == "+=" and type(step.lvalue) is c_ast.ID and \
+                step.lvalue.name == index and type(step.rvalue) is c_ast.Constant and step.rvalue.value == "1":
+            return index
+        return None
+
+    def find_loop_nest(self, node: c_ast.Node) -> list[c_ast.For]:
+        loops = [node]
+        if self.reductions or self.canonical_loop_index(node) is None:
+            return loops
+        while len(loops) < 3:
+            inner = loops[-1].stmt
+            if type(inner) is c_ast.Compound and inner.block_items and len(inner.block_items) == 1:
+                inner = inner.block_items[0]
+            index = self.canonical_loop_index(inner)
+            if index is None:
+                break
+            # Bounds depending on an outer index make the iteration space non-rectangular
+            bounds = AccessVisitor()
+            bounds.visit(inner.cond.right)
+            if bounds.accessed & {self.canonical_loop_index(loop) for loop in loops}:
+                break
+            # Beyond what collapse(n) allows, only nest loops whose iterations are provably independent
+            if len(loops) >= self.collapse and not self.iterations_independent(inner, index):
+                break
+            loops.append(inner)
+        return loops
+
+    def indexed_by(self, node: c_ast.Node, index: str) -> bool:
+        while type(node) is c_ast.ArrayRef:
+            subscript = node.subscript
+            if type(subscript) is c_ast.ID and subscript.name == index:
+                return True
+            if type(subscript) is c_ast.BinaryOp and subscript.op == "+":
+                for term, other in ((subscript.left, subscript.right), (subscript.right, subscript.left)):
+                    rest = AccessVisitor()
+                    rest.visit(other)
+                    if type(term) is c_ast.ID and term.name == index and index not in rest.accessed:
+                        return True
+            node = node.name
+        return False
+
+    def iterations_independent(self, loop: c_ast.For, index: str) -> bool:
+        # Every shared write must land on an element selected by this loop's index,
+        # and written arrays must only be read at exactly the element being written
+        body = AccessVisitor()
+        body.visit(loop.stmt)
+        renderer = TranslationVisitor()
+        written_elements: dict[str, set[str]] = {}
+        for target in body.write_targets:
+            base = self.find_base_variable(target)
+            if base is None:
+                return False
+            if base.name in body.declared:
+                continue
+            if type(target) is not c_ast.ArrayRef or not self.indexed_by(target, index):
+                return False
+            written_elements.setdefault(base.name, set()).add(renderer.visit(target))
+        for ref in body.array_refs:
+            base = self.find_base_variable(ref)
+            if base is not None and base.name in written_elements and \
+                    renderer.visit(ref) not in written_elements[base.name]:
+                return False
+        return True
+
+    def find_vector_operands(self, body: c_ast.Node, index: str) -> Optional[tuple[set[str], set[str], set[str]]]:
+        # Bodies that only do arithmetic on the index-th element of each array can run several
+        # consecutive iterations as one vector operation
+        statements = body.block_items if type(body) is c_ast.Compound else [body]
+        if not statements:
+            return None
+        arrays: set[str] = set()
+        scalars: set[str] = set()
+        constant_types: set[str] = set()
+        for statement in statements:
+            if type(statement) is not c_ast.Assignment or statement.op not in ("=", "+=", "-=", "*=", "/=") or \
+                    type(statement.lvalue) is not c_ast.ArrayRef:
+                return None
+            for expr in (statement.lvalue, statement.rvalue):
+                if not self.find_vector_operand(expr, index, arrays, scalars, constant_types):
+                    return None
+        return arrays, scalars, constant_types
+
+    def find_vector_operand(self, node: c_ast.Node, index: str, arrays: set[str], scalars: set[str],
+                            constant_types: set[str]) -> bool:
+        if type(node) is c_ast.ArrayRef:
+            if type(node.name) is not c_ast.ID or type(node.subscript) is not c_ast.ID or \
+                    node.subscript.name != index:
+                return False
+            arrays.add(node.name.name)
+            return True
+        elif type(node) is c_ast.ID:
+            scalars.add(node.name)
+            return node.name != index
+        elif type(node) is c_ast.Constant:
+            constant_types.add(node.type)
+            return True
+        elif type(node) is c_ast.BinaryOp:
+            return node.op in ("+", "-", "*", "/") and \
+                self.find_vector_operand(node.left, index, arrays, scalars, constant_types) and \
+                self.find_vector_operand(node.right, index, arrays, scalars, constant_types)
+        elif type(node) is c_ast.UnaryOp:
+            return node.op == "-" and self.find_vector_operand(node.expr, index, arrays, scalars, constant_types)
+        return False
+
+    def translate_vector_expression(self, node: c_ast.Node, index: str) -> str:
+        if type(node) is c_ast.ArrayRef:
+            name = self.renamed_variables.get(node.name.name, node.name.name)
+            return f"vload{self.vector_width}(0, {name} + {index})"
+        elif type(node) is c_ast.ID:
+            return self.renamed_variables.get(node.name, node.name)
+        elif type(node) is c_ast.Constant:
+            # Double constants would promote a float vector, which OpenCL doesn't allow
+            if node.type == "double" and not node.value.lower().endswith(("f", "l")):
+                return node.value + "f"
+            return node.value
+        elif type(node) is c_ast.BinaryOp:
+            return "(" + self.translate_vector_expression(node.left, index) + f" {node.op} " + \
+                self.translate_vector_expression(node.right, index) + ")"
+        else:
+            return "(-" + self.translate_vector_expression(node.expr, index) + ")"
+
+    def translate_vector_statement(self, node: c_ast.Assignment, index: str) -> str:
+        value = self.translate_vector_expression(node.rvalue, index)
+        if node.op != "=":
+            value = f"({self.translate_vector_expression(node.lvalue, index)} {node.op[0]} {value})"
+        name = self.renamed_variables.get(node.lvalue.name.name, node.lvalue.name.name)
+        return f"vstore{self.vector_width}({value}, 0, {name} + {index})"
+
     def generate_argument_type(self, node: c_ast.Node) -> str:
         if type(node) is c_ast.PtrDecl or type(node) is c_ast.ArrayDecl:
             return "__global " + self.visit(node)
@@ -136,29 +362,29 @@ class TranslationVisitor(c_ast.NodeVisitor):
             return self.visit(node)
 
     def visit_FuncDef(self, node: c_ast.Node) -> str:
-        output: str = ""
         whitespace: str = "    " * self.level_of_indentation
 
         renamed = self.renamed_variables.get(node.decl.name)
         func_name: str = renamed if renamed else node.decl.name
         func_type: str = self.visit(node.decl.type.type)
 
-        output += whitespace + func_type + " " + func_name + "("
+        self.emit(whitespace + func_type + " " + func_name + "(")
 
-        output += ", ".join([
+        self.emit(", ".join([
             self.generate_argument_type(param.type) + " " +
             (self.renamed_variables[param.name] if self.renamed_variables.get(param.name) else param.name)
             for param in node.decl.type.args
-        ]) + ") {\n"
+        ]) + ") {\n")
 
         if type(node.body) is c_ast.Compound:
-            output += self.visit(node.body)
+            self.visit(node.body)
         else:
-            output += (self.level_of_indentation + 1) * "    " + self.visit(node.body)
+            self.emit((self.level_of_indentation + 1) * "    ")
+            self.emit(self.visit(node.body))
 
-        output += whitespace + "}\n"
+        self.emit(whitespace + "}\n")
 
-        return output
+        return ""
 
     def visit_Decl(self, node: c_ast.Node) -> str:
         if self.omp_mode and node.name:
@@ -175,6 +401,8 @@ class TranslationVisitor(c_ast.NodeVisitor):
         name = renamed if renamed else node.name
         if self.omp_mode and node.name not in self.declared_in_omp:
             self.undeclared_in_omp.add(node.name)
+        if self.omp_mode and node is not self.assignment_target:
+            self.read_in_omp.add(node.name)
         if not renamed and node.name in self.reserved_words:
             renamed = node.name + "$"
             self.renamed_variables[node.name] = renamed
@@ -211,72 +439,135 @@ class TranslationVisitor(c_ast.NodeVisitor):
         if self.omp_parallel_for:
             self.omp_parallel_for = False
             self.level_of_indentation += 1
-            output = ""
             whitespace = "    " * self.level_of_indentation
             indexes = []
+            loops = self.find_loop_nest(node)
+            body = loops[-1].stmt
+
+            if len(loops) > 1:
+                # The innermost loop varies fastest, so it gets dimension 0
+                self.domain_sizes = [self.visit(loop.cond.right) for loop in reversed(loops)]
+                indexes = [self.canonical_loop_index(loop) for loop in reversed(loops)]
+                self.declared_in_omp.update(indexes)
+            else:
+                if type(node.cond) is c_ast.BinaryOp:
+                    self.domain_sizes = [self.visit(node.cond.right)]
 
-            if type(node.cond) is c_ast.BinaryOp:
-                self.domain_size = self.visit(node.cond.right)
-
-            if type(node.init) is c_ast.Assignment:
-                indexes.append(node.init.lvalue.name)
-                self.declared_in_omp.add(node.init.lvalue.name)
-            elif type(node.init) is c_ast.Decl:
-                if self.omp_mode:
-                    self.declared_in_omp.add(node.init.name)
-                indexes.append(node.init.name)
-            elif type(node.init) is c_ast.DeclList:
-                for init in node.init:
+                if type(node.init) is c_ast.Assignment:
+                    indexes.append(node.init.lvalue.name)
+                    self.declared_in_omp.add(node.init.lvalue.name)
+                elif type(node.init) is c_ast.Decl:
                     if self.omp_mode:
-                        self.declared_in_omp.add(init.name)
-                    indexes.append(init.name)
-
-            for i, index in enumerate(indexes):
-                output += whitespace + f"int {index} = get_global_id({i});\n"
-
-            output += whitespace + "if(!("
-            cond = self.visit(node.cond)
-            output += cond + "))\n"
-            output += whitespace + "    " + "return;\n"
-
-            if type(node.stmt) is c_ast.Compound:
-                self.level_of_indentation -= 1
-                output += self.visit(node.stmt)
+                        self.declared_in_omp.add(node.init.name)
+                    indexes.append(node.init.name)
+                elif type(node.init) is c_ast.DeclList:
+                    for init in node.init:
+                        if self.omp_mode:
+                            self.declared_in_omp.add(init.name)
+                        indexes.append(init.name)
+
+            for loop in loops:
+                index = self.canonical_loop_index(loop)
+                if index is not None:
+                    self.loop_bounds[index] = self.visit(loop.cond.right)
+            for i, index in reversed(list(enumerate(indexes))) if len(loops) > 1 else enumerate(indexes):
+                if i == 0 and (self.coarsening > 1 or self.vector_width > 1):
+                    continue
+                self.emit(whitespace + f"int {index} = get_global_id({i});\n")
+            if self.coarsening > 1:
+                # Each work-item runs several iterations of the innermost loop, either spread a global size
+                # apart or next to each other
+                self.emit(whitespace + f"for (int omp_coarsen_step = 0; omp_coarsen_step < {self.coarsening}; "
+                                       "omp_coarsen_step++) {\n")
+                self.level_of_indentation += 1
+                whitespace = "    " * self.level_of_indentation
+                if self.coarsening_mode == "blocked":
+                    self.emit(whitespace + f"int {indexes[0]} = get_global_id(0) * {self.coarsening} + "
+                                           "omp_coarsen_step;\n")
+                else:
+                    self.emit(whitespace + f"int {indexes[0]} = get_global_id(0) + "
+                                           "omp_coarsen_step * get_global_size(0);\n")
+            cond = " && ".join(self.visit(loop.cond) for loop in loops)
+
+            if self.vector_width > 1:
+                # Work-items with a whole vector of iterations run them together, the last one
+                # finishes off any remainder one iteration at a time
+                index = indexes[0]
                 self.level_of_indentation += 1
+                if type(body) is c_ast.Compound:
+                    scalar_body = self.render(body)
+                else:
+                    scalar_body = whitespace + "        " + self.render(body) + ";\n"
+                self.level_of_indentation -= 1
+                statements = body.block_items if type(body) is c_ast.Compound else [body]
+                self.emit(whitespace + f"int {index} = get_global_id(0) * {self.vector_width};\n")
+                self.emit(whitespace + f"if ({index} + {self.vector_width} <= {self.visit(node.cond.right)}) {{\n")
+                for statement in statements:
+                    self.emit(whitespace + "    " + self.translate_vector_statement(statement, index) + ";\n")
+                self.emit(whitespace + "} else {\n")
+                self.emit(whitespace + f"    for (; {cond}; {index}++) {{\n")
+                self.emit(scalar_body)
+                self.emit(whitespace + "    }\n")
+                self.emit(whitespace + "}\n")
+            elif self.reductions:
+                # Work-items past the end of the loop still have to take part in the reduction
+                self.emit(whitespace + "if (" + cond + ") {\n")
+                if type(body) is c_ast.Compound:
+                    self.visit(body)
+                else:
+                    self.emit(whitespace + "    ")
+                    self.emit(self.visit(body) + ";\n")
+                self.emit(whitespace + "}\n")
             else:
-                output += whitespace + self.visit(node.stmt) + ";\n"
-
+                self.emit(whitespace + "if(!(")
+                self.emit(cond + "))\n")
+                self.emit(whitespace + "    " + "return;\n")
+
+                if type(body) is c_ast.Compound:
+                    self.level_of_indentation -= 1
+                    self.visit(body)
+                    self.level_of_indentation += 1
+                else:
+                    self.emit(whitespace)
+                    self.emit(self.visit(body) + ";\n")
+
+            if self.coarsening > 1:
+                self.level_of_indentation -= 1
+                self.emit("    " * self.level_of_indentation + "}\n")
             self.level_of_indentation -= 1
         else:
             whitespace = self.level_of_indentation * "    "
-            output = "for ("
             init = self.visit(node.init) if node.init else ""
             cond = self.visit(node.cond) if node.cond else ""
             nxt = self.visit(node.next) if node.next else ""
-            output += init + "; " + cond + "; " + nxt + ") {\n"
+            self.emit("for (" + init + "; " + cond + "; " + nxt + ") {\n")
+            self.conditional_depth += 1
             if type(node.stmt) is c_ast.Compound:
-                output += self.visit(node.stmt)
+                self.visit(node.stmt)
             else:
-                output += (self.level_of_indentation + 1) * "    " + self.visit(node.stmt) + ";\n"
-            output += whitespace + "}"
-        return output
+                self.emit((self.level_of_indentation + 1) * "    ")
+                self.emit(self.visit(node.stmt) + ";\n")
+            self.conditional_depth -= 1
+            self.emit(whitespace + "}")
+        return ""
 
     def visit_While(self, node: c_ast.Node) -> str:
         whitespace = self.level_of_indentation * "    "
-        output = "while ("
         cond = self.visit(node.cond) if node.cond else ""
-        output += cond + ") {\n"
+        self.emit("while (" + cond + ") {\n")
+        self.conditional_depth += 1
         if type(node.stmt) is c_ast.Compound:
-            output += self.visit(node.stmt)
+            self.visit(node.stmt)
         else:
-            output += (self.level_of_indentation + 1) * "    " + self.visit(node.stmt) + ";\n"
-        output += whitespace + "}"
-        return output
+            self.emit((self.level_of_indentation + 1) * "    ")
+            self.emit(self.visit(node.stmt) + ";\n")
+        self.conditional_depth -= 1
+        self.emit(whitespace + "}")
+        return ""
 
     def visit_Compound(self, node: c_ast.Node) -> str:
         # Parent node is responsible for any indentation of opening brace
         # as well as newlines after closing brace, for flexibility in style
-        output: str = ""
         self.level_of_indentation += 1
         whitespace: str = "    " * self.level_of_indentation
         for child in node:
@@ -285,12 +576,18 @@ class TranslationVisitor(c_ast.NodeVisitor):
                 line_terminate = "\n"
             else:
                 line_terminate = ";\n"
-            output += whitespace + self.visit(child) + line_terminate
+            self.emit(whitespace)
+            self.emit(self.visit(child) + line_terminate)
         self.level_of_indentation -= 1
-        return output
+        return ""
 
     def visit_FuncCall(self, node: c_ast.Node) -> str:
         args = ", ".join([self.visit(arg) for arg in node.args]) if node.args else ""
+        if node.args:
+            for arg in node.args:
+                # Pointers handed to a function may be written through
+                for operand in self.find_pointer_operands(arg):
+                    self.record_write(operand)
         if node.name.name == "omp_get_num_threads":
             return "get_global_size(0)"
         elif node.name.name == "omp_get_thread_num":
@@ -311,6 +608,8 @@ class TranslationVisitor(c_ast.NodeVisitor):
 
     def visit_UnaryOp(self, node: c_ast.Node) -> str:
         op = node.op
+        if op in ("++", "--", "p++", "p--", "&"):
+            self.record_write(node.expr)
         if op == "sizeof":
             return op + "(" + self.visit(node.expr) + ")"
         elif op[0] == "p":
@@ -319,54 +618,80 @@ class TranslationVisitor(c_ast.NodeVisitor):
             return "(" + node.op + self.visit(node.expr) + ")"
 
     def visit_TernaryOp(self, node: c_ast.Node) -> str:
-        return "(" + self.visit(node.cond) + " ? " + self.visit(node.iftrue) + " : " + self.visit(node.iffalse) + ")"
+        cond = self.visit(node.cond)
+        self.conditional_depth += 1
+        output = "(" + cond + " ? " + self.visit(node.iftrue) + " : " + self.visit(node.iffalse) + ")"
+        self.conditional_depth -= 1
+        return output
 
     def visit_Constant(self, node: c_ast.Node) -> str:
         return node.value
 
     def visit_If(self, node: c_ast.Node) -> str:
         whitespace = self.level_of_indentation * "    "
-        output = "if (" + self.visit(node.cond) + ") {\n"
+        self.emit("if (" + self.visit(node.cond) + ") {\n")
+        self.conditional_depth += 1
         if type(node.iftrue) == c_ast.Compound:
-            output += self.visit(node.iftrue)
+            self.visit(node.iftrue)
         else:
-            output += (self.level_of_indentation + 1) * "    " + self.visit(node.iftrue) + ";\n"
+            self.emit((self.level_of_indentation + 1) * "    ")
+            self.emit(self.visit(node.iftrue) + ";\n")
         if node.iffalse:
             if type(node.iffalse) == c_ast.If:
-                output += whitespace + "} else " + self.visit(node.iffalse)
+                self.emit(whitespace + "} else ")
+                self.visit(node.iffalse)
             elif type(node.iffalse) == c_ast.Compound:
-                output += whitespace + "} else {\n" + self.visit(node.iffalse)
-                output += whitespace + "}"
+                self.emit(whitespace + "} else {\n")
+                self.visit(node.iffalse)
+                self.emit(whitespace + "}")
             else:
-                output += whitespace + "} else {\n" + (self.level_of_indentation + 1) * "    " + \
-                          self.visit(node.iffalse) + ";"
-                output += "\n" + whitespace + "}"
+                self.emit(whitespace + "} else {\n" + (self.level_of_indentation + 1) * "    ")
+                self.emit(self.visit(node.iffalse) + ";")
+                self.emit("\n" + whitespace + "}")
         else:
-            output += whitespace + "}"
-        return output
+            self.emit(whitespace + "}")
+        self.conditional_depth -= 1
+        return ""
 
     def visit_Switch(self, node: c_ast.Node) -> str:
         whitespace = self.level_of_indentation * "    "
-        output = "switch (" + self.visit(node.cond) + ") {\n"
-        output += self.visit(node.stmt)
-        output += whitespace + "}"
-        return output
+        self.emit("switch (" + self.visit(node.cond) + ") {\n")
+        self.conditional_depth += 1
+        self.visit(node.stmt)
+        self.conditional_depth -= 1
+        self.emit(whitespace + "}")
+        return ""
 
     def visit_Case(self, node: c_ast.Node) -> str:
         self.level_of_indentation += 1
         whitespace = self.level_of_indentation * "    "
-        output = "case " + self.visit(node.expr) + ":\n"
+        self.emit("case " + self.visit(node.expr) + ":\n")
         for stmt in node.stmts:
             seperator = (";\n" if type(stmt) not in (c_ast.If, c_ast.For, c_ast.While, c_ast.DoWhile,
                                                      c_ast.Switch, c_ast.Case) else "\n")
-            output += whitespace + self.visit(stmt) + seperator
+            self.emit(whitespace)
+            self.emit(self.visit(stmt) + seperator)
         self.level_of_indentation -= 1
-        return output
+        return ""
 
     def visit_Assignment(self, node: c_ast.Node) -> str:
-        return self.visit(node.lvalue) + f" {node.op} " + self.visit(node.rvalue)
+        lvalue = node.lvalue
+        bound = None
+        if node.op == "=" and self.conditional_depth == 0 and type(lvalue) is c_ast.ArrayRef and \
+                type(lvalue.name) is c_ast.ID and type(lvalue.subscript) is c_ast.ID:
+            bound = self.loop_bounds.get(lvalue.subscript.name)
+        self.record_write(lvalue, bound)
+
+        outer_target = self.assignment_target
+        self.assignment_target = self.find_base_variable(lvalue)
+        output = self.visit(lvalue)
+        self.assignment_target = outer_target
+        return output + f" {node.op} " + self.visit(node.rvalue)
 
     def visit_ArrayRef(self, node: c_ast.Node) -> str:
+        if type(node.name) is c_ast.ID and node.name.name in self.streamed_arrays:
+            # Streamed buffers only hold the chunk starting at the launch's global offset
+            return self.visit(node.name) + "[(" + self.visit(node.subscript) + " - get_global_offset(0))]"
         return self.visit(node.name) + "[" + self.visit(node.subscript) + "]"
 
     def visit_DeclList(self, node: c_ast.Node) -> str:
@@ -413,47 +738,520 @@ class TranslationVisitor(c_ast.NodeVisitor):
         return ""
 
 
+class AccessVisitor(c_ast.NodeVisitor):
+    accessed: set[str]
+    written: set[str]
+    write_targets: list[c_ast.Node]
+    array_refs: list[c_ast.ArrayRef]
+    dereferenced: set[str]  # pointers and arrays read or written through, or handed to a function
+    declared: set[str]
+    called: set[str]
+    jumps: bool
+    uses: dict[str, int]
+
+    def __init__(self):
+        self.accessed = set()
+        self.uses = {}
+        self.written = set()
+        self.write_targets = []
+        self.array_refs = []
+        self.dereferenced = set()
+        self.declared = set()
+        self.called = set()
+        self.jumps = False
+
+    def record_write(self, node: c_ast.Node) -> None:
+        self.write_targets.append(node)
+        base = TranslationVisitor().find_base_variable(node)
+        if base is not None:
+            self.written.add(base.name)
+
+    def record_dereference(self, node: c_ast.Node) -> None:
+        base = TranslationVisitor().find_base_variable(node)
+        if base is not None:
+            self.dereferenced.add(base.name)
+
+    def visit_ID(self, node: c_ast.Node) -> None:
+        self.accessed.add(node.name)
+        self.uses[node.name] = self.uses.get(node.name, 0) + 1
+
+    def visit_Decl(self, node: c_ast.Node) -> None:
+        if node.name:
+            self.declared.add(node.name)
+        self.generic_visit(node)
+
+    def visit_ArrayRef(self, node: c_ast.Node) -> None:
+        # Only the outermost reference of a[i][j] is recorded
+        self.array_refs.append(node)
+        self.record_dereference(node)
+        while type(node) is c_ast.ArrayRef:
+            self.visit(node.subscript)
+            node = node.name
+        self.visit(node)
+
+    def visit_Assignment(self, node: c_ast.Node) -> None:
+        self.record_write(node.lvalue)
+        self.generic_visit(node)
+
+    def visit_UnaryOp(self, node: c_ast.Node) -> None:
+        if node.op in ("++", "--", "p++", "p--", "&"):
+            self.record_write(node.expr)
+        if node.op == "*":
+            self.record_dereference(node.expr)
+        self.generic_visit(node)
+
+    def visit_StructRef(self, node: c_ast.Node) -> None:
+        if node.type == "->":
+            self.record_dereference(node.name)
+        self.visit(node.name)
+
+    def visit_FuncCall(self, node: c_ast.Node) -> None:
+        if type(node.name) is c_ast.ID:
+            self.called.add(node.name.name)
+        if node.args:
+            for arg in node.args:
+                # Pointers handed to a function may be written through, scalars only passed by value
+                operands = TranslationVisitor().find_pointer_operands(arg)
+                self.write_targets.extend(operands)
+                self.dereferenced.update(operand.name for operand in operands)
+            self.visit(node.args)
+
+    def visit_Return(self, node: c_ast.Node) -> None:
+        self.jumps = True
+        self.generic_visit(node)
+
+    def visit_Break(self, node: c_ast.Node) -> None:
+        self.jumps = True
+
+    def visit_Continue(self, node: c_ast.Node) -> None:
+        self.jumps = True
+
+    def visit_Goto(self, node: c_ast.Node) -> None:
+        self.jumps = True
+
+    def visit_Label(self, node: c_ast.Node) -> None:
+        self.jumps = True
+        self.generic_visit(node)
+
+
 @dataclass
 class KernelArg:
     name: str
     type: c_ast.Node
     size: str
+    read: bool = True
+    written: bool = True
+    resident: Optional[str] = None  # global cl_mem shared with other kernels or a target data region
+    create: bool = True
+    release: bool = True
+    reduction: Optional[str] = None
+
+    def is_buffer(self) -> bool:
+        return type(self.type) is c_ast.PtrDecl or type(self.type) is c_ast.ArrayDecl
 
 
 @dataclass
 class KernelInfo:
     src_start_line: int
-    domain_size: str
+    domain_sizes: Optional[list[str]]  # one extent per NDRange dimension, None for omp parallel regions
     name: str
     args: list[KernelArg]
+    offload_threshold: int = 0  # smaller domains run the original OpenMP loop on the host
+    coarsening: int = 1  # loop iterations run by each work-item in dimension 0
+    streamed: bool = False  # buffers are moved through the device in chunks while the kernel runs
+    asynchronous: bool = False  # returns before the kernel finishes, the host waits where it needs the results
+    dependencies: list[int] = field(default_factory=list)  # earlier asynchronous kernels using the same arrays
+    synchronizes: list[int] = field(default_factory=list)  # asynchronous kernels waited for before returning
+    local_sizes: Optional[list[int]] = None  # tuned work-group size, one entry per NDRange dimension
+
+
+@dataclass
+class DataRegionInfo:
+    src_start_line: int
+    buffers: list[KernelArg]
+
+
+@dataclass
+class SymbolIndex:
+    functions: dict[str, c_ast.FuncDef] = field(default_factory=dict)
+    struct_defs: dict[str, c_ast.Struct] = field(default_factory=dict)
+    typedef_defs: dict[str, c_ast.Typedef] = field(default_factory=dict)
+    global_vars: set[str] = field(default_factory=set)
+
+
+class SymbolIndexer(c_ast.NodeVisitor):
+    index: SymbolIndex
+    within_typedef: bool
+
+    def __init__(self):
+        self.index = SymbolIndex()
+        self.within_typedef = False
+
+    def visit_FileAST(self, node: c_ast.Node) -> None:
+        for child in node:
+            if type(child) is c_ast.FuncDef:
+                self.index.functions.setdefault(child.decl.name, child)
+            elif type(child) is c_ast.Decl and type(child.type) is not c_ast.FuncDecl:
+                self.index.global_vars.add(child.name)
+            self.visit(child)
+
+    def visit_Typedef(self, node: c_ast.Node) -> None:
+        self.within_typedef = True
+        self.index.typedef_defs[node.name] = node
+        for child in node:
+            self.visit(child)
+        self.within_typedef = False
+
+    def visit_Struct(self, node: c_ast.Node) -> None:
+        # Structs defined by a typedef are reached through the typedef, but structs nested inside them aren't
+        must_reset_within_typedef = False
+        if not self.within_typedef and node.decls and node.name:
+            self.index.struct_defs[node.name] = node
+
+        if self.within_typedef:
+            must_reset_within_typedef = True
+            self.within_typedef = False
+        for child in node:
+            self.visit(child)
+        if must_reset_within_typedef:
+            self.within_typedef = True
+
+
+def index_symbols(ast: c_ast.FileAST) -> SymbolIndex:
+    indexer = SymbolIndexer()
+    indexer.visit(ast)
+    return indexer.index
+
+
+class NodeHasher(c_ast.NodeVisitor):
+    # Hashes the structure of subtrees without their coordinates, and collects the names they refer to
+    references: set[tuple[str, str]]
+
+    def __init__(self):
+        self.digest = hashlib.sha256()
+        self.references = set()
+
+    def update(self, value) -> None:
+        self.digest.update(json.dumps(value).encode())
+
+    def hexdigest(self) -> str:
+        return self.digest.hexdigest()
+
+    def generic_visit(self, node: c_ast.Node) -> None:
+        self.digest.update(repr((type(node).__name__, [getattr(node, name) for name in node.attr_names])).encode())
+        if type(node) is c_ast.ID:
+            self.references.add(("id", node.name))
+        elif type(node) is c_ast.IdentifierType:
+            self.references.update(("type", name) for name in node.names)
+        elif type(node) is c_ast.Struct and node.name:
+            self.references.add(("struct", node.name))
+        for child in node:
+            self.visit(child)
+        self.digest.update(b")")
+
+
+class RegionFinder(c_ast.NodeVisitor):
+    # Finds the statements Translator.visit_Compound turns into kernels, before any are translated
+    expressions = (c_ast.Decl, c_ast.DeclList, c_ast.Typedef, c_ast.Assignment, c_ast.FuncCall, c_ast.Return,
+                   c_ast.BinaryOp, c_ast.UnaryOp, c_ast.TernaryOp, c_ast.Cast, c_ast.ID, c_ast.Constant,
+                   c_ast.ArrayRef, c_ast.StructRef, c_ast.ExprList)
+
+    regions: list[tuple[str, c_ast.Node, str]]  # enclosing function, statement and a hash of it and its pragma
+    references: dict[int, set[tuple[str, str]]]  # statement id to the names it refers to
+    shapes: dict[int, str]  # statement id to a hash of its pragma and loop header, which survives edits to the body
+    function: str
+
+    def __init__(self):
+        self.regions = []
+        self.references = {}
+        self.shapes = {}
+        self.function = ""
+
+    def generic_visit(self, node: c_ast.Node) -> None:
+        # Pragmas are statements, so they are never found inside declarations or expressions
+        for child in node:
+            if not isinstance(child, self.expressions):
+                self.visit(child)
+
+    def visit_FuncDef(self, node: c_ast.Node) -> None:
+        self.function = node.decl.name
+        self.visit(node.body)
+
+    @staticmethod
+    def shape(pragma: str, node: c_ast.Node) -> str:
+        hasher = NodeHasher()
+        hasher.update([pragma, type(node).__name__])
+        if type(node) is c_ast.For:
+            for child in (node.init, node.cond, node.next):
+                if child is not None:
+                    hasher.visit(child)
+        return hasher.hexdigest()
+
+    def visit_Compound(self, node: c_ast.Node) -> None:
+        pragma = None
+        for child in node:
+            if pragma is not None:
+                hasher = NodeHasher()
+                hasher.update(pragma)
+                hasher.visit(child)
+                self.regions.append((self.function, child, hasher.hexdigest()))
+                self.references[id(child)] = hasher.references
+                self.shapes[id(child)] = self.shape(pragma, child)
+                pragma = None
+            elif type(child) is c_ast.Pragma and child.string.startswith("omp parallel"):
+                pragma = child.string
+            elif not isinstance(child, self.expressions):
+                self.visit(child)
+
+
+def similarity(shape: str, references: set[tuple[str, str]], kernel: dict) -> Optional[float]:
+    # None when the pragma or loop header differ, otherwise the share of names both bodies refer to
+    if kernel.get("shape") != shape:
+        return None
+    previous = {tuple(reference) for reference in kernel.get("references", [])}
+    return len(references & previous) / len(references | previous) if references | previous else 1.0
+
+
+def pair_regions(gap: list[int], candidates: list[int], scores: dict[tuple[int, int], float]) -> Optional[dict]:
+    # Repeatedly pairs a region and a previous kernel that are each other's only best match. Returns None when a
+    # region still has a match left but no unique one, since any pairing would then be a guess
+    pairs = {}
+    gap = list(gap)
+    candidates = list(candidates)
+    while True:
+        best_kernel = {}
+        best_region = {}
+        for r in gap:
+            matches = [(scores[r, i], i) for i in candidates if (r, i) in scores]
+            if matches:
+                top = max(matches)[0]
+                best_kernel[r] = [i for score, i in matches if score == top]
+        for i in candidates:
+            matches = [(scores[r, i], r) for r in gap if (r, i) in scores]
+            if matches:
+                top = max(matches)[0]
+                best_region[i] = [r for score, r in matches if score == top]
+        found = [(r, kernels[0]) for r, kernels in best_kernel.items()
+                 if len(kernels) == 1 and best_region[kernels[0]] == [r]]
+        if not found:
+            return None if best_kernel else pairs
+        for r, i in found:
+            pairs[r] = i
+            gap.remove(r)
+            candidates.remove(i)
+
+
+def assign_kernel_names(regions: list[tuple[str, c_ast.Node, str]], shapes: dict[int, str],
+                        references: dict[int, set[tuple[str, str]]], manifest: dict) -> tuple[dict[int, str], int]:
+    # Unchanged regions keep their names wherever they moved to. A changed region takes the name of a changed region
+    # between the same unchanged neighbours in its function. Where there are several of either, each region takes the
+    # name of the one with the same pragma and loop header whose body refers to the most of the same names, and if
+    # that is ambiguous every region there is treated as new. New regions get numbers that are never reused
+    previous = manifest.get("kernels", [])
+    next_kernel_id = manifest.get("next_kernel_id", 0)
+    by_identity = {}
+    for i, kernel in enumerate(previous):
+        by_identity.setdefault(kernel["identity"], []).append(i)
+    matched: dict[int, int] = {}  # region to the previous kernel it is
+    for r, (function, node, identity) in enumerate(regions):
+        if by_identity.get(identity):
+            matched[r] = by_identity[identity].pop(0)
+
+    # The previous kernels of the nearest matched regions before and after each region in the same function
+    before = {}
+    last = {}
+    for r, (function, node, identity) in enumerate(regions):
+        before[r] = last.get(function, -1)
+        if r in matched:
+            last[function] = matched[r]
+    after = {}
+    last = {}
+    for r, (function, node, identity) in reversed(list(enumerate(regions))):
+        after[r] = last.get(function, len(previous))
+        if r in matched:
+            last[function] = matched[r]
+
+    # Changed regions between the same unchanged neighbours share the same previous kernels to choose from
+    gaps = {}
+    for r, (function, node, identity) in enumerate(regions):
+        if r not in matched:
+            gaps.setdefault((function, before[r], after[r]), []).append(r)
+    claimed = set(matched.values())
+    for (function, start, end), gap in gaps.items():
+        candidates = [i for i in range(start + 1, end) if i not in claimed and previous[i]["function"] == function]
+        if len(gap) == 1 and len(candidates) == 1:
+            matched[gap[0]] = candidates[0]
+            continue
+        scores = {}
+        for r in gap:
+            node = regions[r][1]
+            for i in candidates:
+                score = similarity(shapes[id(node)], references[id(node)], previous[i])
+                if score is not None:
+                    scores[r, i] = score
+        matched.update(pair_regions(gap, candidates, scores) or {})
+
+    names = {}
+    for r, (function, node, identity) in enumerate(regions):
+        if r in matched:
+            names[id(node)] = previous[matched[r]]["name"]
+        else:
+            names[id(node)] = f"omp_translated_kernel{next_kernel_id}"
+            next_kernel_id += 1
+    return names, next_kernel_id
+
+
+@dataclass
+class TranslationResult:
+    kernel_source: str
+    kernels_info: list[KernelInfo]
+    data_regions_info: list[DataRegionInfo]
+    sync_points: dict[int, list[int]]
+    functions_generated: list[str]
+    structs_generated: list[str]
+    typedefs_generated: list[str]
+    manifest: Optional[dict] = None  # only kept when translating incrementally
+    kernels_reused: list[str] = field(default_factory=list)
+
+
+def translate_ast(ast: c_ast.FileAST, coarsening: Optional[dict[str, int]] = None, coarsening_mode: str = "strided",
+                  vector_width: int = 1, streaming: bool = False, asynchronous: bool = False,
+                  manifest: Optional[dict] = None) -> TranslationResult:
+    # A translator per call keeps concurrent translations from sharing any state; the ast is only read
+    translator = Translator()
+    translator.set_coarsening(coarsening or {}, coarsening_mode)
+    translator.set_vector_width(vector_width)
+    translator.set_streaming(streaming)
+    translator.set_asynchronous(asynchronous)
+    translator.set_previous_manifest(manifest)
+    return translator.translate_ast(ast)
 
 
 class Translator(c_ast.NodeVisitor):
-    var_types: dict[str, c_ast.Node] = {}
-    struct_defs: dict[str, c_ast.Node] = {}
-    typedef_defs: dict[str, c_ast.Node] = {}
-    next_omp_kernel_id: int = 0
-    kernels: list[str] = []
-    functions: list[str] = []
-    functions_generated: set[str] = set()
-    structs: dict[str, str] = {}
-    typedefs: dict[str, str] = {}
-    kernels_info: list[KernelInfo] = []
-    var_sizes: dict[str, c_ast.Node] = {}
-    file_ast: c_ast.Node
-    within_typedef: bool = False
+    var_types: dict[str, c_ast.Node]
+    symbols: SymbolIndex
+    next_omp_kernel_id: int
+    kernels: list[str]
+    functions: list[str]
+    functions_generated: set[str]
+    structs: dict[str, str]
+    typedefs: dict[str, str]
+    kernels_info: list[KernelInfo]
+    data_regions_info: list[DataRegionInfo]
+    data_regions: list[DataRegionInfo]
+    next_resident_id: int
+    var_sizes: dict[str, c_ast.Node]
+    pointer_targets: dict[str, Optional[set[str]]]  # arrays each pointer may point into, None if unknown
+    sync_points: dict[int, list[int]]  # source line to the asynchronous kernels waited for before it
+    kernel_names: dict[int, str]  # statement id to the name its kernel keeps from the previous manifest
+    regions: dict[int, tuple[str, str, str, set[tuple[str, str]]]]  # statement id to its function, hash, shape, names
+    previous_kernels: dict[str, dict]
+    manifest_kernels: list[dict]
+    next_kernel_id: int
+    kernels_reused: list[str]
+    version: str
+    dependency_digests: dict[int, tuple[str, set[tuple[str, str]]]]  # node id to its hash and references
+
+    coarsening: dict[str, int]  # keyed by kernel name, or "" for every kernel
+    coarsening_mode: str
+    vector_width: int
+    streaming: bool
+    asynchronous: bool
+    previous_manifest: Optional[dict]  # None unless translating incrementally
+
+    def __init__(self):
+        self.coarsening = {}
+        self.coarsening_mode = "strided"
+        self.vector_width = 1
+        self.streaming = False
+        self.asynchronous = False
+        self.previous_manifest = None
+        self.reset()
+
+    def reset(self) -> None:
+        # Everything found in a file is kept on the instance, so translators don't see each other's files
+        self.var_types = {}
+        self.symbols = SymbolIndex()
+        self.next_omp_kernel_id = 0
+        self.kernels = []
+        self.functions = []
+        self.functions_generated = set()
+        self.structs = {}
+        self.typedefs = {}
+        self.kernels_info = []
+        self.data_regions_info = []
+        self.data_regions = []
+        self.next_resident_id = 0
+        self.var_sizes = {}
+        self.pointer_targets = {}
+        self.sync_points = {}
+        self.kernel_names = {}
+        self.regions = {}
+        self.previous_kernels = {}
+        self.manifest_kernels = []
+        self.next_kernel_id = 0
+        self.kernels_reused = []
+        self.version = ""
+        self.dependency_digests = {}
+
+    def translate_ast(self, ast: c_ast.FileAST) -> TranslationResult:
+        self.reset()
+        kernel_source = self.visit(ast)
+        manifest = None
+        if self.previous_manifest is not None:
+            manifest = {"next_kernel_id": self.next_kernel_id, "kernels": self.manifest_kernels}
+        return TranslationResult(kernel_source, self.kernels_info, self.data_regions_info, self.sync_points,
+                                 sorted(self.functions_generated), list(self.structs), list(self.typedefs),
+                                 manifest, self.kernels_reused)
+
+    def set_coarsening(self, coarsening: dict[str, int], coarsening_mode: str) -> None:
+        self.coarsening = coarsening
+        self.coarsening_mode = coarsening_mode
+
+    def set_vector_width(self, vector_width: int) -> None:
+        self.vector_width = vector_width
+
+    def set_streaming(self, streaming: bool) -> None:
+        self.streaming = streaming
+
+    def set_asynchronous(self, asynchronous: bool) -> None:
+        self.asynchronous = asynchronous
+
+    def set_previous_manifest(self, manifest: Optional[dict]) -> None:
+        self.previous_manifest = manifest
 
     def get_kernels_info(self) -> list[KernelInfo]:
         return self.kernels_info
 
+    def get_data_regions_info(self) -> list[DataRegionInfo]:
+        return self.data_regions_info
+
+    def get_sync_points(self) -> dict[int, list[int]]:
+        return self.sync_points
+
     def visit_FileAST(self, node: c_ast.Node) -> str:
-        self.file_ast = node
+        # Functions, types and globals are looked up for every region, so they are indexed once up front
+        self.symbols = index_symbols(node)
+        if self.previous_manifest is not None:
+            self.prepare_incremental(node)
         for child in node:
             self.visit(child)
         return (";\n\n".join(reversed(self.structs.values())) + ";\n\n" if self.structs else "") + \
                (";\n\n".join(reversed(self.typedefs.values())) + ";\n\n" if self.typedefs else "") + \
             "\n".join(self.functions) + "\n".join(self.kernels)
 
+    def prepare_incremental(self, node: c_ast.FileAST) -> None:
+        # Kernels are named before any is translated, since matching them to the previous manifest needs every region
+        finder = RegionFinder()
+        finder.visit(node)
+        self.kernel_names, self.next_kernel_id = assign_kernel_names(finder.regions, finder.shapes, finder.references,
+                                                                     self.previous_manifest)
+        for function, statement, identity in finder.regions:
+            self.regions[id(statement)] = (function, identity, finder.shapes[id(statement)],
+                                           finder.references[id(statement)])
+        self.previous_kernels = {kernel["name"]: kernel for kernel in self.previous_manifest.get("kernels", [])}
+        self.version = cache.translator_version()
+
     def visit_Decl(self, node: c_ast.Node) -> None:
         self.var_types[node.name] = node.type
         self.var_sizes[node.name] = None
@@ -462,6 +1260,8 @@ class Translator(c_ast.NodeVisitor):
         elif type(node.type) is c_ast.PtrDecl and node.init and type(node.init) is c_ast.FuncCall\
                 and node.init.name.name == "malloc":
             self.var_sizes[node.name] = node.init.args.exprs[0]
+        if type(node.type) is c_ast.PtrDecl:
+            self.pointer_targets[node.name] = self.find_pointer_targets(node.init)
         for child in node:
             self.visit(child)
 
@@ -472,119 +1272,463 @@ class Translator(c_ast.NodeVisitor):
                 rvalue = rvalue.expr
             if type(rvalue) is c_ast.FuncCall and rvalue.name.name == "malloc":
                 self.var_sizes[node.lvalue.name] = rvalue.args.exprs[0]
+            if type(self.var_types.get(node.lvalue.name)) is c_ast.PtrDecl and node.op == "=":
+                self.pointer_targets[node.lvalue.name] = self.find_pointer_targets(node.rvalue)
         for child in node:
             self.visit(child)
 
-    def visit_Typedef(self, node: c_ast.Node) -> None:
-        self.within_typedef = True
-        self.typedef_defs[node.name] = node
-        for child in node:
-            self.visit(child)
-        self.within_typedef = False
-
-    def visit_Struct(self, node: c_ast.Node) -> None:
-        must_reset_within_typedef = False
-        if not self.within_typedef and node.decls and node.name:
-            self.struct_defs[node.name] = node
-
-        if self.within_typedef:
-            must_reset_within_typedef = True
-            self.within_typedef = False
-        for child in node:
-            self.visit(child)
-        if must_reset_within_typedef:
-            self.within_typedef = True
+    def find_pointer_targets(self, node: Optional[c_ast.Node]) -> Optional[set[str]]:
+        # The arrays a pointer expression may point into: none for a fresh allocation or a constant, the array
+        # itself and everything it may point into for an array or another pointer
+        while type(node) is c_ast.Cast:
+            node = node.expr
+        if type(node) is c_ast.Constant or \
+                type(node) is c_ast.FuncCall and type(node.name) is c_ast.ID and node.name.name in ("malloc", "calloc"):
+            return set()
+        if type(node) is c_ast.UnaryOp and node.op == "&":
+            base = TranslationVisitor().find_base_variable(node.expr)
+            operands = [base] if base is not None else []
+        else:
+            operands = TranslationVisitor().find_pointer_operands(node) if node is not None else []
+        if not operands:
+            return None
+        targets = set()
+        for operand in operands:
+            var_type = self.var_types.get(operand.name)
+            if type(var_type) is c_ast.ArrayDecl:
+                targets.add(operand.name)
+            elif type(var_type) is c_ast.PtrDecl:
+                if self.pointer_targets.get(operand.name) is None:
+                    return None
+                targets |= self.pointer_targets[operand.name] | {operand.name}
+        return targets
+
+    def touched_by(self, code: AccessVisitor, arrays: set[str]) -> set[str]:
+        # Host code touches an array through its name or a pointer into it. Any pointer whose target isn't known
+        # might point into any of them, though kernel buffers themselves are already taken not to overlap
+        for name in code.dereferenced - arrays:
+            if type(self.var_types.get(name)) is c_ast.PtrDecl and self.pointer_targets.get(name) is None:
+                return set(arrays)
+        touched = arrays & code.accessed
+        for name in code.accessed:
+            touched |= arrays & (self.pointer_targets.get(name) or set())
+        return touched
 
     def visit_Compound(self, node: c_ast.Node) -> None:
         omp_parallel: bool = False
         omp_parallel_for: bool = False
+        target_data: Optional[c_ast.Pragma] = None
+        omp_pragma: str = ""
+        # Buffers left on the device by the most recent kernels, and the host code run since
+        resident: dict[str, KernelArg] = {}
+        host_code = AccessVisitor()
+        # Asynchronous kernels the host hasn't waited for yet, and the last kernel or host statement
+        pending: list[int] = []
+        last_kernel: Optional[int] = None
+        last_line: Optional[int] = None
         for child in node:
-            if omp_parallel:
-                self.extract_kernel_from_omp(child)
+            if omp_parallel or omp_parallel_for:
+                self.extract_kernel_from_omp(child, omp_parallel_for, omp_pragma)
+                self.keep_buffers_resident(resident, host_code, self.kernels_info[-1])
+                self.schedule_kernel(pending)
+                host_code = AccessVisitor()
                 omp_parallel = False
-            elif omp_parallel_for:
-                self.extract_kernel_from_omp(child, True)
                 omp_parallel_for = False
+                last_kernel = len(self.kernels_info) - 1
+                last_line = None
+            elif target_data:
+                statement = AccessVisitor()
+                statement.visit(child)
+                self.wait_for_kernels(pending, statement, target_data.coord.line)
+                last_line = target_data.coord.line
+                self.extract_data_region(target_data, child)
+                host_code.visit(child)
+                target_data = None
             elif type(child) == c_ast.Pragma:
+                omp_pragma = child.string
                 if child.string.startswith("omp parallel for"):
                     omp_parallel_for = True
                 elif child.string.startswith("omp parallel"):
                     omp_parallel = True
+                elif child.string.startswith("omp target data"):
+                    target_data = child
             else:
+                statement = AccessVisitor()
+                statement.visit(child)
+                self.wait_for_kernels(pending, statement, child.coord.line)
+                last_line = child.coord.line
                 self.visit(child)
+                host_code.visit(child)
+
+        # Anything still running has to finish before control leaves the block
+        if pending and last_line is None:
+            self.kernels_info[last_kernel].asynchronous = False
+            self.kernels_info[last_kernel].synchronizes = [k for k in pending if k != last_kernel]
+        elif pending:
+            self.sync_points.setdefault(last_line, []).extend(pending)
+
+    def schedule_kernel(self, pending: list[int]) -> None:
+        kernel_id = len(self.kernels_info) - 1
+        kernel_info = self.kernels_info[kernel_id]
+        kernel_info.dependencies = [k for k in pending if self.kernels_conflict(self.kernels_info[k], kernel_info)]
+        # Reductions combine partial results on the host and streamed kernels already overlap their own transfers
+        if self.asynchronous and not kernel_info.streamed and not any(arg.reduction for arg in kernel_info.args):
+            kernel_info.asynchronous = True
+            pending.append(kernel_id)
+
+    def kernels_conflict(self, first: KernelInfo, second: KernelInfo) -> bool:
+        for first_arg in first.args:
+            for second_arg in second.args:
+                if first_arg.name != second_arg.name or not first_arg.is_buffer():
+                    continue
+                if first_arg.written or second_arg.written or \
+                        first_arg.resident is not None and first_arg.resident == second_arg.resident:
+                    return True
+        return False
+
+    def wait_for_kernels(self, pending: list[int], statement: AccessVisitor, line: int) -> None:
+        calls_file_functions = any(self.find_function_def(call) for call in statement.called)
+        waiting = []
+        for k in pending:
+            arrays = {arg.name for arg in self.kernels_info[k].args if arg.is_buffer()}
+            if statement.jumps or self.touched_by(statement, arrays) or \
+                    calls_file_functions and arrays & self.symbols.global_vars:
+                waiting.append(k)
+        if waiting:
+            self.sync_points.setdefault(line, []).extend(waiting)
+            pending[:] = [k for k in pending if k not in waiting]
+
+    def keep_buffers_resident(self, resident: dict[str, KernelArg], host_code: AccessVisitor,
+                              kernel_info: KernelInfo) -> None:
+        # A buffer can stay on the device between two kernels if the host code in between
+        # cannot have touched the array or changed its size
+        if kernel_info.streamed:
+            resident.clear()
+            return
+        calls_file_functions = any(self.find_function_def(call) for call in host_code.called)
+        touched = self.touched_by(host_code, set(resident))
+        for name, arg in list(resident.items()):
+            size_vars = set(re.findall(r"[A-Za-z_]\w*", arg.size))
+            if host_code.jumps or name in touched or size_vars & host_code.written or \
+                    calls_file_functions and name in self.symbols.global_vars:
+                del resident[name]
+
+        for arg in kernel_info.args:
+            if not arg.is_buffer() or arg.resident:
+                continue
+            previous = resident.get(arg.name)
+            if previous and previous.size == arg.size:
+                if previous.resident is None:
+                    previous.resident = f"{arg.name}_resident{self.next_resident_id}"
+                    self.next_resident_id += 1
+                previous.release = False
+                arg.resident = previous.resident
+                arg.create = False
+                # Whatever earlier kernels wrote still has to reach the host
+                arg.written = arg.written or previous.written
+            resident[arg.name] = arg
+
+    def extract_data_region(self, pragma: c_ast.Pragma, node: c_ast.Node) -> None:
+        region = DataRegionInfo(pragma.coord.line, [])
+        size_visitor = TranslationVisitor()
+        for map_type, names in re.findall(r"map\s*\(\s*(?:(to|from|tofrom|alloc)\s*:)?([^)]*)\)", pragma.string):
+            map_type = map_type or "tofrom"
+            for name in names.split(","):
+                name = name.split("[")[0].strip()
+                if not name or name not in self.var_types:
+                    continue
+                size_val = "0"
+                if self.var_sizes.get(name):
+                    _, size_val = size_visitor.translate_omp_parallel_for(self.var_sizes[name])
+                region.buffers.append(KernelArg(name, self.var_types[name], size_val,
+                                                map_type in ("to", "tofrom"), map_type in ("from", "tofrom"),
+                                                f"{name}_resident{self.next_resident_id}"))
+                self.next_resident_id += 1
+        self.data_regions_info.append(region)
+
+        self.data_regions.append(region)
+        self.visit(node)
+        self.data_regions.pop()
+
+    def find_data_region_buffer(self, name: str) -> Optional[KernelArg]:
+        for region in reversed(self.data_regions):
+            for buffer in region.buffers:
+                if buffer.name == name:
+                    return buffer
+        return None
+
+    def extract_kernel_from_omp(self, node: c_ast.Node, parallel_for: bool = False, pragma: str = "") -> None:
+        k_id = self.next_omp_kernel_id
+        self.next_omp_kernel_id += 1
+        # Regions matched to the previous manifest keep the name they had, so renumbering doesn't touch them
+        kernel_name: str = self.kernel_names.get(id(node), f"omp_translated_kernel{k_id}")
+        kernel = None
+        if self.previous_manifest is not None:
+            region_hash = self.hash_region(node, kernel_name)
+            previous = self.previous_kernels.get(kernel_name)
+            if previous and previous["hash"] == region_hash:
+                kernel = previous
+                self.kernels_reused.append(kernel_name)
+        if kernel is None:
+            kernel = self.translate_kernel(node, kernel_name, parallel_for, pragma)
+        if self.previous_manifest is not None:
+            function, identity, shape, references = self.regions[id(node)]
+            self.manifest_kernels.append(dict(kernel, function=function, identity=identity, shape=shape,
+                                              references=sorted(references), hash=region_hash))
+
+        args_info = [KernelArg(arg["name"], self.var_types[arg["name"]], arg["size"], arg["read"], arg["written"],
+                               reduction=arg["reduction"]) for arg in kernel["args"]]
+        for arg_info in args_info:
+            mapped = self.find_data_region_buffer(arg_info.name)
+            if arg_info.is_buffer() and mapped:
+                arg_info.resident = mapped.resident
+                arg_info.create = False
+                arg_info.release = False
+
+        self.kernels.append(kernel["source"])
+        self.kernels_info.append(KernelInfo(node.coord.line, kernel["domain_sizes"], kernel_name, args_info,
+                                            coarsening=kernel["coarsening"], streamed=kernel["streamed"]))
+
+        trans_visitor = TranslationVisitor()
+        self.retrieve_types(set(kernel["structs"]), set(kernel["typedefs"]), trans_visitor)
+
+        # Sorted so the helper functions come out in the same order on every run
+        function_calls = kernel["calls"]
+        while function_calls:
+            new_calls = set()
+            for call in sorted(function_calls):
+                if call in self.functions_generated:
+                    continue
+                function_def = self.find_function_def(call)
+                if function_def is not None:
+                    self.functions.append(trans_visitor.translate_function(function_def, kernel["renamed"]))
+                    new_calls.update(trans_visitor.get_function_calls())
+                    self.functions_generated.add(call)
+            function_calls = new_calls
 
-    def extract_kernel_from_omp(self, node: c_ast.Node, parallel_for: bool = False) -> None:
+    def translate_kernel(self, node: c_ast.Node, kernel_name: str, parallel_for: bool, pragma: str) -> dict:
         # Need to visit this entire subtree, while keeping track of
         # declared + used variables -- used but not declared == kernel argument
-        k_id = self.next_omp_kernel_id
-        self.next_omp_kernel_id += 1
-        kernel_name: str = f"omp_translated_kernel{k_id}"
         output: str = f"__kernel void {kernel_name}("
         trans_visitor: TranslationVisitor = TranslationVisitor()
 
-        line = node.coord.line
-        domain_size = None
+        domain_sizes = None
+        reductions = parse_reduction_clauses(pragma)
+        collapse = re.search(r"collapse\s*\(\s*(\d+)\s*\)", pragma)
+        coarsening = 1
+        streamed_arrays = None
         if parallel_for:
-            domain_size, function_body = trans_visitor.translate_omp_parallel_for(node)
+            coarsening = self.coarsening.get(kernel_name, self.coarsening.get("", 1))
+            coarsening_mode = self.coarsening_mode
+            coarsen = re.search(r"coarsen\s*\(\s*(\d+)\s*(?:,\s*(strided|blocked)\s*)?\)", pragma)
+            if coarsen:
+                coarsening = int(coarsen.group(1))
+                coarsening_mode = coarsen.group(2) or coarsening_mode
+            vector_width = self.find_vector_width(node) if coarsening == 1 and not reductions else 1
+            streamed_arrays = None
+            if coarsening == 1 and vector_width == 1 and not reductions:
+                streamed_arrays = self.find_streamed_arrays(node, int(collapse.group(1)) if collapse else 1)
+            domain_sizes, function_body = trans_visitor.translate_omp_parallel_for(
+                node, reductions, int(collapse.group(1)) if collapse else 1, coarsening, coarsening_mode,
+                vector_width, streamed_arrays)
+            # Each work-item covers one vector's worth of iterations
+            coarsening *= vector_width
         else:
-            function_body = trans_visitor.translate_omp_parallel(node)
+            function_body = trans_visitor.translate_omp_parallel(node, reductions)
         args = trans_visitor.get_omp_kernel_args()
-        function_calls = trans_visitor.get_function_calls()
+        reads = trans_visitor.get_omp_reads()
+        writes = trans_visitor.get_omp_writes()
+        whole_writes = trans_visitor.get_whole_writes()
         renamed_variables = trans_visitor.get_renamed_variables()
 
         args_info: list[KernelArg] = []
         args_code: list[str] = []
         args_from_size: set[str] = set()
         size_visitor = TranslationVisitor()
-        for arg in args:
+        # Arguments are sorted so a kernel's signature is the same on every run
+        for arg in sorted(args):
             size_val = "0"
             size = self.var_sizes[arg]
             if size:
                 _, size_val = size_visitor.translate_omp_parallel_for(size)
             args_from_size.update(size_visitor.get_omp_kernel_args())
-            args_info.append(KernelArg(arg, self.var_types[arg], size_val))
+            # Buffers the loop doesn't write from end to end keep the rest of their contents from the host
+            count = self.element_count(arg)
+            read = arg in reads or arg in writes and (count is None or count not in whole_writes.get(arg, set()))
+            args_info.append(KernelArg(arg, self.var_types[arg], size_val, read, arg in writes,
+                                       reduction=reductions.get(arg)))
             args_code.append(trans_visitor.generate_argument_type(self.var_types[arg]) + " " +
-                             (renamed_variables[arg] if renamed_variables.get(arg) else arg))
+                             (renamed_variables[arg] if renamed_variables.get(arg) and arg not in reductions else arg))
 
-        for arg in args_from_size:
+        for arg in sorted(args_from_size):
             if arg in args:
                 continue
             args_info.append(KernelArg(arg, self.var_types[arg], "0"))  # Assume anything in size not buffer
             args_code.append(trans_visitor.generate_argument_type(self.var_types[arg]) + " " +
                              (renamed_variables[arg] if renamed_variables.get(arg) else arg))
 
-        output += ", ".join(args_code) + ") {\n"
-        output += function_body + "}\n"
-        self.kernels.append(output)
-        self.kernels_info.append(KernelInfo(line, domain_size, kernel_name, args_info))
-
-        structs = trans_visitor.get_structs()
-        typedefs = trans_visitor.get_typedefs_used()
-
-        self.retrieve_types(structs, typedefs, trans_visitor)
+        reduction_prologue = ""
+        reduction_epilogue = ""
+        for arg_info in args_info:
+            if not arg_info.reduction:
+                continue
+            name = arg_info.name
+            tp = trans_visitor.visit(arg_info.type)
+            args_code.append(f"__global {tp}* {name}_partials")
+            args_code.append(f"__local {tp}* {name}_scratch")
+            init = REDUCTION_IDENTITIES.get(arg_info.reduction, name)
+            reduction_prologue += f"    {tp} {name}_private = {init};\n"
+            # Tree reduction within the work-group, leaving one partial result per group for the host
+            reduction_epilogue += (
+                f"    {name}_scratch[get_local_id(0)] = {name}_private;\n"
+                "    barrier(CLK_LOCAL_MEM_FENCE);\n"
+                "    for (size_t offset = get_local_size(0) / 2; offset > 0; offset >>= 1) {\n"
+                "        if (get_local_id(0) < offset)\n"
+                f"            {name}_scratch[get_local_id(0)] = " +
+                reduction_combine(arg_info.reduction, f"{name}_scratch[get_local_id(0)]",
+                                  f"{name}_scratch[get_local_id(0) + offset]") + ";\n"
+                "        barrier(CLK_LOCAL_MEM_FENCE);\n"
+                "    }\n"
+                "    if (get_local_id(0) == 0)\n"
+                f"        {name}_partials[get_group_id(0)] = {name}_scratch[0];\n"
+            )
 
-        while function_calls:
-            new_calls = set()
-            for call in function_calls:
-                if call in self.functions_generated:
-                    continue
-                function_def = self.find_function_def(call)
-                if function_def is not None:
-                    self.functions.append(trans_visitor.translate_function(function_def, renamed_variables))
-                    new_calls.update(trans_visitor.get_function_calls())
-                    self.functions_generated.add(call)
-            function_calls = new_calls
+        output += ", ".join(args_code) + ") {\n"
+        output += reduction_prologue + function_body + reduction_epilogue + "}\n"
+
+        # Everything the rest of the translation needs from the kernel, in the form kept in the manifest
+        return {
+            "name": kernel_name,
+            "source": output,
+            "domain_sizes": domain_sizes,
+            "coarsening": coarsening,
+            "streamed": streamed_arrays is not None,
+            "args": [{"name": arg.name, "size": arg.size, "read": arg.read, "written": arg.written,
+                      "reduction": arg.reduction} for arg in args_info],
+            "calls": sorted(trans_visitor.get_function_calls()),
+            "structs": sorted(trans_visitor.get_structs()),
+            "typedefs": sorted(trans_visitor.get_typedefs_used()),
+            "renamed": renamed_variables,
+        }
+
+    def element_count(self, name: str) -> Optional[str]:
+        # Arrays are sized in elements, malloc calls in bytes, which only give a count as n * sizeof(type)
+        size = self.var_sizes.get(name)
+        if size is None:
+            return None
+        if type(self.var_types[name]) is c_ast.PtrDecl:
+            if type(size) is not c_ast.BinaryOp or size.op != "*":
+                return None
+            if type(size.right) is c_ast.UnaryOp and size.right.op == "sizeof":
+                size = size.left
+            elif type(size.left) is c_ast.UnaryOp and size.left.op == "sizeof":
+                size = size.right
+            else:
+                return None
+        _, count = TranslationVisitor().translate_omp_parallel_for(size)
+        return count
+
+    def hash_region(self, node: c_ast.Node, kernel_name: str) -> str:
+        # Covers everything the kernel's translation reads: the region and its pragma, the options, and the
+        # declarations, sizes, functions and types it refers to, followed transitively
+        _, identity, _, references = self.regions[id(node)]
+        hasher = NodeHasher()
+        hasher.update([self.version, identity, self.coarsening.get(kernel_name, self.coarsening.get("", 1)),
+                       self.coarsening_mode, self.vector_width, self.streaming])
+        hasher.references = set(references)
+        seen = set()
+        while hasher.references - seen:
+            for kind, name in sorted(hasher.references - seen):
+                seen.add((kind, name))
+                if kind == "id":
+                    dependencies = [self.var_types.get(name), self.var_sizes.get(name), self.find_function_def(name)]
+                    hasher.update([kind, name, self.find_data_region_buffer(name) is not None])
+                elif kind == "struct":
+                    dependencies = [self.symbols.struct_defs.get(name)]
+                    hasher.update([kind, name])
+                else:
+                    dependencies = [self.symbols.typedef_defs.get(name)]
+                    hasher.update([kind, name])
+                for dependency in dependencies:
+                    digest, references = self.digest_dependency(dependency)
+                    hasher.update(digest)
+                    hasher.references |= references
+        return hasher.hexdigest()
+
+    def digest_dependency(self, node: Optional[c_ast.Node]) -> tuple[Optional[str], set[tuple[str, str]]]:
+        # Helper functions and types are shared by many regions, so each is only hashed once
+        if node is None:
+            return None, set()
+        if id(node) not in self.dependency_digests:
+            hasher = NodeHasher()
+            hasher.visit(node)
+            self.dependency_digests[id(node)] = (hasher.hexdigest(), hasher.references)
+        return self.dependency_digests[id(node)]
+
+    def find_vector_width(self, node: c_ast.Node) -> int:
+        if self.vector_width == 1:
+            return 1
+        visitor = TranslationVisitor()
+        index = visitor.canonical_loop_index(node)
+        operands = visitor.find_vector_operands(node.stmt, index) if index else None
+        if operands is None:
+            return 1
+        # Vector types only mix with scalars that convert to their element type without promotion
+        arrays, scalars, constant_types = operands
+        element_types = {self.find_type_name(self.var_types.get(name), 1) for name in arrays}
+        if element_types == {"float"}:
+            allowed_types = {"float", "int"}
+            allowed_constants = {"float", "double", "int"}
+        elif element_types == {"int"}:
+            allowed_types = {"int"}
+            allowed_constants = {"int"}
+        else:
+            return 1
+        if any(self.find_type_name(self.var_types.get(name), 0) not in allowed_types for name in scalars) or \
+                not constant_types <= allowed_constants:
+            return 1
+        return self.vector_width
+
+    def find_streamed_arrays(self, node: c_ast.For, collapse: int) -> Optional[set[str]]:
+        if not self.streaming:
+            return None
+        visitor = TranslationVisitor()
+        visitor.collapse = collapse
+        index = visitor.canonical_loop_index(node)
+        if index is None or len(visitor.find_loop_nest(node)) > 1:
+            return None
+        # Chunks can only be split off arrays that each iteration touches at its own index alone
+        body = AccessVisitor()
+        body.visit(node.stmt)
+        arrays = {name for name in body.accessed - body.declared
+                  if type(self.var_types.get(name)) in (c_ast.PtrDecl, c_ast.ArrayDecl)}
+        elements = [ref.name.name for ref in body.array_refs
+                    if type(ref.name) is c_ast.ID and type(ref.subscript) is c_ast.ID and ref.subscript.name == index]
+        if not arrays or any(body.uses[name] != elements.count(name) for name in arrays):
+            return None
+        # Buffers a data region keeps on the device can't be streamed
+        if any(self.find_data_region_buffer(name) for name in arrays):
+            return None
+        return arrays
+
+    def find_type_name(self, node: Optional[c_ast.Node], depth: int) -> Optional[str]:
+        # Strip depth pointer or array levels off a declared type
+        for _ in range(depth):
+            if type(node) not in (c_ast.PtrDecl, c_ast.ArrayDecl):
+                return None
+            node = node.type
+        if type(node) is not c_ast.TypeDecl or type(node.type) is not c_ast.IdentifierType:
+            return None
+        return " ".join(node.type.names)
 
     def find_function_def(self, name: str) -> Optional[c_ast.Node]:
-        for child in self.file_ast:
-            if type(child) is c_ast.FuncDef and child.decl.name == name:
-                return child
+        return self.symbols.functions.get(name)
 
     def retrieve_types(self, structs: set[str], typedefs: set[str], visitor: TranslationVisitor) -> None:
         structs_found: set[str] = set()
         typedefs_found: set[str] = set()
-        for struct_name in structs:
-            struct_node = self.struct_defs[struct_name]
+        for struct_name in sorted(structs):
+            struct_node = self.symbols.struct_defs[struct_name]
             struct_code = visitor.generate_struct_def(struct_node)
             if self.structs.get(struct_name) is None:
                 self.structs[struct_name] = struct_code
@@ -595,8 +1739,8 @@ class Translator(c_ast.NodeVisitor):
                 typedefs_inside = visitor.get_typedefs_used()
                 typedefs_found.update(typedefs_inside)
 
-        for typedef_name in typedefs:
-            typedef_node = self.typedef_defs[typedef_name]
+        for typedef_name in sorted(typedefs):
+            typedef_node = self.symbols.typedef_defs[typedef_name]
             typedef_code = visitor.generate_typedefs(typedef_node)
             if self.typedefs.get(typedef_name) is None:
                 self.typedefs[typedef_name] = typedef_code
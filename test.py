@@ -22,10 +22,9 @@ def main(do_compile, run, translate):
         out_path = outputs_path + file
         out_paths.append(out_path)
         bin_out_paths.append(bin_outputs_path + file[:-2])
-        cl_path = out_path + "l"
-        if translate:
-            #p = subprocess.run(["python", "src/c-to-opencl/__main__.py",  in_path, out_path, cl_path])
-            p = subprocess.run(["python", "-m", "c-to-opencl",  in_path, out_path, cl_path])
+
+    if translate:
+        p = subprocess.run(["python", "-m", "c-to-opencl", "--batch", outputs_path, inputs_path])
 
     if do_compile:
         for in_path, bin_in_path in zip(in_paths, bin_in_paths):